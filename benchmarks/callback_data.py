@@ -0,0 +1,48 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+
+import callback_data  # noqa: E402
+
+CHAT_ID = -1001234567890
+
+
+def legacy_encode(command: str, chat_id: int, path: list[int]) -> str:
+    return '_'.join([command, str(chat_id)] + [str(index) for index in path])
+
+
+def legacy_decode(data: str):
+    # what flow_handler parsed before compact callback_data
+    flow_state = data.split('_')
+    return flow_state[0], int(flow_state[1]), [int(i) for i in flow_state[2:]]
+
+
+def main():
+    number = 100000
+
+    def best_of(function) -> float:
+        return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+    # compact is the text form encode() picks for menus with fewer than 64
+    # choices per level, binary the base64 form it falls back to otherwise
+    print('depth  legacy  compact  binary  legacy decode  compact decode  binary decode')
+    for depth in [1, 4, 8, 16]:
+        path = [(level * 7) % 30 for level in range(depth)]
+        legacy = legacy_encode('removeitem', CHAT_ID, path)
+        compact = callback_data.encode('removeitem', CHAT_ID, path)
+        binary = callback_data._encode_binary('removeitem', CHAT_ID, path)
+        assert (callback_data.decode(compact) == callback_data.decode(binary) == callback_data.decode(legacy) ==
+                ('removeitem', CHAT_ID, path))
+        legacy_time = best_of(lambda: legacy_decode(legacy))
+        compact_time = best_of(lambda: callback_data.decode(compact))
+        binary_time = best_of(lambda: callback_data.decode(binary))
+        print('%5d  %5dB  %6dB  %5dB  %11.2fus  %12.2fus  %11.2fus%s' % (
+            depth, len(legacy), len(compact), len(binary), legacy_time * 1e6, compact_time * 1e6, binary_time * 1e6,
+            '  legacy over %d bytes' % callback_data.CALLBACK_DATA_LIMIT
+            if len(legacy) > callback_data.CALLBACK_DATA_LIMIT else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from typing import Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+os.environ.setdefault('TABLE_NAME', 'benchmark')
+
+from boto3.dynamodb.types import TypeDeserializer  # noqa: E402
+
+import jio  # noqa: E402
+from codec import encode_item  # noqa: E402
+from settlement import aggregate  # noqa: E402
+
+CHAT_ID = -1001234567890
+
+
+class LegacyJio:
+    # the plain __dict__ model that jio.Jio was before __slots__
+    def __init__(self, chat_id, timestamp, starter_id, type, closes, split, gst, delivery, orders):
+        self.chat_id = chat_id
+        self.timestamp = timestamp
+        self.starter_id = starter_id
+        self.type = type
+        self.closes = closes
+        self.split = split
+        self.gst = gst
+        self.delivery = delivery
+        self.orders = orders
+
+
+def legacy_load(items: list[dict[str, Any]]) -> LegacyJio:
+    # what the boto3 resource layer and the old Jio._load did with the same
+    # query response: deserialize every attribute, numbers into Decimal, then
+    # copy the fields by hand
+    deserializer = TypeDeserializer()
+    items = [{key: deserializer.deserialize(value) for key, value in item.items()} for item in items]
+    header = items.pop()
+    orders = {}
+    for item in items:
+        if item['opened'] != header['opened']:
+            continue
+        orders[str(-item['timestamp'])] = {
+            'firstname': item['firstname'],
+            'items': item['items'],
+            'counts': item['counts'],
+            'subtotal': item['subtotal']
+        }
+    return LegacyJio(CHAT_ID, header['opened'], header['starter_id'], header['type'], header['closes'],
+                     header['split'], header['gst'], header['delivery'], orders)
+
+
+class CannedClient:
+    # answers Jio._load's query with a prepared response
+    def __init__(self, items: list[dict[str, Any]]):
+        self.response = {'Items': items}
+
+    def query(self, **kwargs: Any) -> dict[str, Any]:
+        return self.response
+
+
+def build_items(participants: int, items: int) -> list[dict[str, Any]]:
+    random.seed(0)
+    menu = [('Item %d' % index, random.randrange(150, 1500, 10)) for index in range(200)]
+    opened = 1700000000
+    response = []
+    for user_id in range(participants, 0, -1):
+        order_items = [{'item': item, 'price': price} for item, price in random.choices(menu, k=items)]
+        counts, subtotal = aggregate(order_items)
+        response.append(encode_item({
+            'chat_id': CHAT_ID,
+            'timestamp': -user_id,
+            'opened': opened,
+            'firstname': 'User %d' % user_id,
+            'items': order_items,
+            'counts': counts,
+            'subtotal': subtotal
+        }))
+    response.append(encode_item({
+        'chat_id': CHAT_ID,
+        'timestamp': jio.ACTIVE_TIMESTAMP,
+        'opened': opened,
+        'starter_id': 1,
+        'status': 'Open',
+        'type': 'Al Amaan',
+        'closes': 30,
+        'split': 'Weighted',
+        'gst': 'Included',
+        'delivery': 300
+    }))
+    return response
+
+
+def allocations(function) -> tuple[int, int]:
+    # peak bytes allocated while decoding, and bytes still held by the result
+    tracemalloc.start()
+    result = function()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, retained
+
+
+def best_of(function, number: int = 10) -> float:
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main():
+    print('orders  items    legacy     codec  peak legacy/codec  retained legacy/codec')
+    for participants, items in [(100, 5), (300, 5), (500, 10)]:
+        response = build_items(participants, items)
+        jio._DYNAMODB_CLIENT = CannedClient(response)  # type: ignore
+        legacy_time = best_of(lambda: legacy_load(list(response)))
+        codec_time = best_of(lambda: jio.Jio._load(CHAT_ID))
+        legacy_peak, legacy_retained = allocations(lambda: legacy_load(list(response)))
+        codec_peak, codec_retained = allocations(lambda: jio.Jio._load(CHAT_ID))
+        print('%6d  %5d  %6.2fms  %6.2fms  %8dKB / %5dKB  %12dKB / %5dKB' % (
+            participants, items, legacy_time * 1000, codec_time * 1000, legacy_peak // 1024, codec_peak // 1024,
+            legacy_retained // 1024, codec_retained // 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+
+from stub_telegram import StubTelegram  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wall time of the /closejio DM fan-out against a local stub bot api.')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response time in seconds')
+    parser.add_argument('--global-rate', type=float, default=30, help='messages per second across all chats')
+    args = parser.parse_args()
+
+    with StubTelegram(latency=args.latency) as stub:
+        os.environ['BOT_TOKEN'] = 'benchmark'
+        os.environ['TELEGRAM_API_URL'] = stub.url
+        import telegram
+        from dispatch import Dispatcher
+        logging.getLogger('telegram').setLevel(logging.WARNING)
+        dispatcher = Dispatcher(global_rate=args.global_rate)
+        print('recipients  sequential  dispatcher  ok')
+        for recipients in [10, 50, 200]:
+            messages = [(user_id, 'Your food order costs *$9.96* in total') for user_id in range(1, recipients + 1)]
+            start = time.perf_counter()
+            for chat_id, text in messages:
+                telegram.send_message(chat_id, text)
+            sequential = time.perf_counter() - start
+            start = time.perf_counter()
+            results = dispatcher.send_messages(messages)
+            concurrent = time.perf_counter() - start
+            print('%10d  %9.2fs  %9.2fs  %d/%d' % (
+                recipients, sequential, concurrent, sum(result['ok'] for result in results), recipients))
+            # let the global bucket refill between runs
+            time.sleep(recipients / args.global_rate)
+
+
+if __name__ == '__main__':
+    main()
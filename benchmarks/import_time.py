@@ -0,0 +1,57 @@
+import argparse
+import os
+import subprocess
+import sys
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'supper-bot')
+# dummy configuration read at import time
+ENVIRONMENT = {
+    'BOT_ID': '1',
+    'BOT_TOKEN': 'benchmark',
+    'BOT_URL': 't.me/benchmark',
+    'TABLE_NAME': 'benchmark',
+    'AWS_DEFAULT_REGION': 'us-east-1'
+}
+
+
+def import_times(module: str) -> dict[str, int]:
+    # cumulative microseconds of each module imported by a fresh interpreter,
+    # as reported by -X importtime
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        cwd=BOT_DIR, env=dict(os.environ, **ENVIRONMENT), capture_output=True, text=True, check=True)
+    times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        # skip the interpreter's own startup imports
+        if name == 'site':
+            times = {}
+            continue
+        times[name] = max(times.get(name, 0), int(cumulative))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of the lambda handler, from -X importtime.')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters to take the best of')
+    parser.add_argument('--top', type=int, default=10, help='slowest third-party and bot modules to list')
+    args = parser.parse_args()
+
+    runs = [import_times('app') for _ in range(args.repeat)]
+    best = {name: min(run.get(name, 0) for run in runs) for name in runs[0]}
+    print('app: %.1fms' % (best['app'] / 1000))
+    # modules that should only be imported once an update needs them
+    for name in ['boto3', 'botocore', 'requests', 'mypy_boto3_dynamodb']:
+        print('%s: %s' % (name, '%.1fms' % (best[name] / 1000) if name in best else 'not imported'))
+    print('slowest top-level imports:')
+    top_level = [(name, time) for name, time in best.items() if '.' not in name and name != 'app']
+    for name, time in sorted(top_level, key=lambda item: -item[1])[:args.top]:
+        print('  %-24s %7.1fms' % (name, time / 1000))
+
+
+if __name__ == '__main__':
+    main()
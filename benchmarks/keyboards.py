@@ -0,0 +1,42 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+os.environ.setdefault('BOT_URL', 't.me/benchmark')
+
+import app  # noqa: E402
+from app import KEYBOARD_PAGE_SIZE, Command, get_keyboard  # noqa: E402
+from menu import MENU_FILES, get_menu  # noqa: E402
+
+CHAT_ID = -1001234567890
+
+
+def main():
+    # every category of the real menus, i.e. each keyboard of the add item flow
+    for jio_type in MENU_FILES:
+        menu = get_menu(jio_type)
+        paths = [tuple(menu.path(node)) for node in range(len(menu.names)) if not menu.is_item(node)]
+
+        def rebuilt():
+            # built and serialized on every tap, as without the cache
+            return [get_keyboard.__wrapped__(Command.ADD_ITEM.value, CHAT_ID, path, jio_type) for path in paths]
+
+        def cached():
+            return [get_keyboard(Command.ADD_ITEM.value, CHAT_ID, path, jio_type) for path in paths]
+
+        number = 200
+        rebuilt_time = timeit.timeit(rebuilt, number=number) / (number * len(paths))
+        get_keyboard.cache_clear()
+        cached_time = timeit.timeit(cached, number=number) / (number * len(paths))
+        largest_page = max(map(len, cached()))
+        # the same keyboards with every choice on one page
+        app.KEYBOARD_PAGE_SIZE = max(menu.child_count)
+        largest = max(map(len, rebuilt()))
+        app.KEYBOARD_PAGE_SIZE = KEYBOARD_PAGE_SIZE
+        print('%s keyboards=%d rebuilt=%.2fus cached=%.2fus largest=%dB largest_page=%dB (page size %d)' % (
+            jio_type, len(paths), rebuilt_time * 1e6, cached_time * 1e6, largest, largest_page, KEYBOARD_PAGE_SIZE))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import random
+import sys
+import timeit
+from collections import OrderedDict
+from typing import Any, Union
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+
+from menu import MENU_FILES, CompiledMenu, get_menu  # noqa: E402
+
+
+def legacy_get_menu_choices(menu: dict[str, Any], selections: list[int]):
+    # the OrderedDict walk that menu.get_menu_choices used before compilation
+    menu_pointer: Union[dict[str, Any], int] = menu
+    last_key = ''
+    while len(selections):
+        index = selections.pop(0)
+        if isinstance(menu_pointer, dict):
+            last_key = list(menu_pointer.keys())[index]
+            menu_pointer = menu_pointer[last_key]
+        else:
+            return None, (last_key, menu_pointer)
+    if isinstance(menu_pointer, dict):
+        item_names = list(menu_pointer.keys())
+        item_names = ['%s - ($%.2f)' % (item_name, menu_pointer[item_name]/100) if isinstance(
+            menu_pointer[item_name], int) else item_name for item_name in item_names]
+        return item_names, None
+    else:
+        return None, (last_key, menu_pointer)
+
+
+def build_menu(depth: int, fanout: int, prefix: str = '') -> dict[str, Any]:
+    menu: dict[str, Any] = OrderedDict()
+    for index in range(fanout):
+        name = '%s%d' % (prefix, index)
+        if depth == 1:
+            menu['Item %s' % name] = 100 + index
+        else:
+            menu['Category %s' % name] = build_menu(depth - 1, fanout, name + '.')
+    return menu
+
+
+def main():
+    random.seed(0)
+    number = 20000
+    for depth, fanout in [(3, 12), (4, 8), (5, 6), (6, 4)]:
+        menu = build_menu(depth, fanout)
+        compiled = CompiledMenu(menu)
+        items = sum(1 for node in range(len(compiled.names)) if compiled.is_item(node))
+        # every prefix of a random path, i.e. each tap of the add item flow
+        paths = []
+        for _ in range(200):
+            path = [random.randrange(fanout) for _ in range(depth)]
+            paths.extend(path[:length] for length in range(depth + 1))
+
+        def legacy():
+            for path in paths:
+                legacy_get_menu_choices(menu, list(path))
+
+        def navigate():
+            for path in paths:
+                node = compiled.navigate(path)
+                if compiled.is_item(node):
+                    compiled.names[node], compiled.prices[node]
+                else:
+                    compiled.choices[node]
+
+        repeat = max(1, number // len(paths))
+        calls = repeat * len(paths)
+        compile_time = timeit.timeit(lambda: CompiledMenu(menu), number=10) / 10
+        legacy_time = timeit.timeit(legacy, number=repeat) / calls
+        compiled_time = timeit.timeit(navigate, number=repeat) / calls
+        print('depth=%d fanout=%d items=%d compile=%.2fms legacy=%.2fus compiled=%.2fus speedup=%.1fx' % (
+            depth, fanout, items, compile_time * 1000, legacy_time * 1e6, compiled_time * 1e6,
+            legacy_time / compiled_time))
+    # searching the real menus, by the first two words of every item
+    for jio_type in MENU_FILES:
+        menu = get_menu(jio_type)
+        queries = [' '.join(menu.names[node].split()[:2]) for node in range(len(menu.names)) if menu.is_item(node)]
+        search_time = timeit.timeit(lambda: [menu.search(query) for query in queries], number=20) / (20 * len(queries))
+        print('%s items=%d trigrams=%d search=%.2fus' % (jio_type, len(queries), len(menu.trigrams), search_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+
+from stub_dynamodb import StubDynamoDB  # noqa: E402
+from stub_telegram import StubTelegram  # noqa: E402
+
+CHAT_ID = -1001234567890
+STARTER = {'id': 1001, 'is_bot': False, 'first_name': 'Starter'}
+# users with orders in the jio of the view_order and close_jio scenarios
+PARTICIPANTS = 10
+JIO_TYPE = 'Al Amaan'
+
+_update_ids = itertools.count(1)
+
+
+def message(chat_id: int, user: dict[str, Any], text: str) -> dict[str, Any]:
+    command = text.split()[0]
+    return {
+        'update_id': next(_update_ids),
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Supper'},
+            'from': user,
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        }
+    }
+
+
+def callback(user: dict[str, Any], data: str, message_id: int = 100) -> dict[str, Any]:
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(message_id),
+            'from': user,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user['id'], 'type': 'private'}
+            },
+            'data': data
+        }
+    }
+
+
+def item_paths(count: int) -> list[list[int]]:
+    # menu paths of the deepest items, which take the most taps to add
+    from menu import get_menu
+    menu = get_menu(JIO_TYPE)
+    items = [node for node in range(len(menu.names)) if menu.is_item(node)]
+    return [menu.path(node) for node in reversed(items[-count:])]
+
+
+def open_jio(participants: int = 0):
+    # an open jio with one item ordered by each participant
+    from jio import JIO_CLOSES, JIO_GST, JIO_SPLIT, Jio
+    Jio.create(CHAT_ID, STARTER['id'], JIO_TYPE, JIO_CLOSES[0], JIO_SPLIT[1], JIO_GST[0], 300)
+    jio = Jio.exists(CHAT_ID)
+    for user_id in range(1, participants + 1):
+        jio.add_item(user_id, 'User %d' % user_id, 'Teh Ping', 150 + user_id)
+
+
+def closed_jio():
+    # a closed jio in the history of the chat, with an order of the starter
+    # made of menu items, and a new jio open
+    from jio import Jio
+    from menu import get_menu
+    open_jio(PARTICIPANTS)
+    menu = get_menu(JIO_TYPE)
+    jio = Jio.exists(CHAT_ID)
+    for path in item_paths(2):
+        node = menu.navigate(path)
+        jio.add_item(STARTER['id'], STARTER['first_name'], menu.names[node], menu.prices[node])
+    jio.close()
+    open_jio()
+
+
+def favourite_jio():
+    # an open jio in a chat where the starter has often ordered an item
+    from jio import record_popularity
+    from menu import get_menu
+    open_jio()
+    menu = get_menu(JIO_TYPE)
+    record_popularity(CHAT_ID, STARTER['id'], {menu.names[menu.navigate(item_paths(1)[0])]: 5})
+
+
+# scenario -> (setup, updates of one iteration)
+def scenarios() -> dict[str, tuple[Callable[[], None], Callable[[], list[dict[str, Any]]]]]:
+    import callback_data
+
+    def add_items() -> list[dict[str, Any]]:
+        updates = [message(CHAT_ID, STARTER, '/additem')]
+        for path in item_paths(2):
+            # 'Add another item' goes back to the top of the menu
+            updates.append(callback(STARTER, callback_data.encode('additem', CHAT_ID, [])))
+            updates.extend(callback(STARTER, callback_data.encode('additem', CHAT_ID, path[:level]))
+                           for level in range(1, len(path) + 1))
+        return updates
+
+    def search_items() -> list[dict[str, Any]]:
+        # the same items added by picking the first result of /additem <query>
+        from menu import get_menu
+        menu = get_menu(JIO_TYPE)
+        updates = []
+        for path in item_paths(2):
+            name = menu.names[menu.navigate(path)]
+            updates.append(message(CHAT_ID, STARTER, '/additem %s' % name))
+            updates.append(callback(STARTER, callback_data.encode('additem', CHAT_ID, path)))
+        return updates
+
+    def quantity_items() -> list[dict[str, Any]]:
+        # 4 of the same item: picked from search results, then +3
+        from menu import get_menu
+        menu = get_menu(JIO_TYPE)
+        path = item_paths(1)[0]
+        return [
+            message(CHAT_ID, STARTER, '/additem %s' % menu.names[menu.navigate(path)]),
+            callback(STARTER, callback_data.encode('additem', CHAT_ID, path)),
+            callback(STARTER, callback_data.encode('additem', CHAT_ID, path + [3]))
+        ]
+
+    def typed_order() -> list[dict[str, Any]]:
+        # 3 of one item and 2 of another in a single message
+        from menu import get_menu
+        menu = get_menu(JIO_TYPE)
+        names = [menu.names[menu.navigate(path)] for path in item_paths(2)]
+        return [message(CHAT_ID, STARTER, '/additem 3x %s, 2x %s' % tuple(names))]
+
+    def favourite_item() -> list[dict[str, Any]]:
+        # the same deep item as add_items, from the favourites row
+        return [
+            message(CHAT_ID, STARTER, '/additem'),
+            callback(STARTER, callback_data.encode('additem', CHAT_ID, item_paths(1)[0]))
+        ]
+
+    return {
+        'open_jio': (lambda: None, lambda: [message(CHAT_ID, STARTER, '/openjio')]),
+        'open_jio_flow': (lambda: None, lambda: [
+            callback(STARTER, callback_data.encode('openjio', CHAT_ID, [0] * stage)) for stage in range(1, 5)]),
+        'add_items': (open_jio, add_items),
+        'search_items': (open_jio, search_items),
+        'quantity_items': (open_jio, quantity_items),
+        'favourite_item': (favourite_jio, favourite_item),
+        'typed_order': (open_jio, typed_order),
+        'view_order': (lambda: open_jio(PARTICIPANTS), lambda: [message(CHAT_ID, STARTER, '/vieworder')]),
+        'history': (closed_jio, lambda: [message(CHAT_ID, STARTER, '/history')]),
+        'reorder': (closed_jio, lambda: [message(CHAT_ID, STARTER, '/reorder')]),
+        'close_jio': (lambda: open_jio(PARTICIPANTS), lambda: [message(CHAT_ID, STARTER, '/closejio')])
+    }
+
+
+def recorded(path: str) -> Callable[[], list[dict[str, Any]]]:
+    # one update per line, replayed with fresh update ids so that none are
+    # skipped as redelivered
+    with open(path) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    return lambda: [dict(update, update_id=next(_update_ids)) for update in updates]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def replay(dynamodb: StubDynamoDB, telegram: StubTelegram, setup: Callable[[], None],
+           updates: Callable[[], list[dict[str, Any]]], iterations: int) -> dict[str, Any]:
+    from app import lambda_handler
+    from outbox import OUTBOX_CHAT_ID, drain
+    latencies: list[float] = []
+    dynamodb_calls: dict[str, int] = {}
+    telegram_calls: dict[str, int] = {}
+    webhook_replies = 0
+    count = 0
+    # the first iteration warms up caches and connections and is not counted
+    for iteration in range(iterations + 1):
+        dynamodb.reset(items=True)
+        setup()
+        batch = updates()
+        dynamodb.reset()
+        telegram.reset()
+        for update in batch:
+            start = time.perf_counter()
+            response = lambda_handler({'body': json.dumps(update)}, None)
+            elapsed = time.perf_counter() - start
+            if iteration:
+                latencies.append(elapsed)
+                webhook_replies += response['body'] is not None
+        # the outbox consumer sends deferred messages after the webhook has
+        # answered, counted in the calls but not the latencies
+        if any(chat_id == OUTBOX_CHAT_ID and timestamp < 0 for chat_id, timestamp in dynamodb.items):
+            drain()
+        if iteration:
+            count = len(batch)
+            for operation, calls in dynamodb.calls.items():
+                dynamodb_calls[operation] = dynamodb_calls.get(operation, 0) + calls
+            for method, calls in telegram.calls.items():
+                telegram_calls[method] = telegram_calls.get(method, 0) + calls
+    return {
+        'updates': count,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        # per iteration, so that the numbers do not depend on --iterations
+        'dynamodb': {operation: calls / iterations for operation, calls in dynamodb_calls.items()},
+        'telegram': {method: calls / iterations for method, calls in telegram_calls.items()},
+        'webhook_replies': webhook_replies / iterations
+    }
+
+
+def breakdown(calls: dict[str, float]) -> str:
+    return ' '.join('%s=%g' % (name, calls[name]) for name in sorted(calls)) or '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay telegram updates through lambda_handler against in-process dynamodb and bot api stand-ins.')
+    parser.add_argument('--iterations', type=int, default=50, help='replays of each scenario')
+    parser.add_argument('--updates', help='file of recorded updates, one json object per line, replayed as a scenario')
+    parser.add_argument('--dynamodb-latency', type=float, default=0, help='seconds added to every dynamodb call')
+    parser.add_argument('--telegram-latency', type=float, default=0, help='seconds added to every bot api call')
+    parser.add_argument('--no-timings', action='store_true', help='only print call counts, which diff exactly')
+    args = parser.parse_args()
+
+    dynamodb = StubDynamoDB(latency=args.dynamodb_latency)
+    with StubTelegram(latency=args.telegram_latency) as telegram:
+        os.environ.update({
+            'BOT_ID': '1',
+            'BOT_OWNER': '2',
+            'BOT_TOKEN': 'replay',
+            'BOT_URL': 't.me/replay',
+            'TABLE_NAME': 'replay',
+            'TELEGRAM_API_URL': telegram.url,
+            # measure the bot rather than the rate limits of the dispatcher
+            'TELEGRAM_GLOBAL_RATE': '1000000',
+            'TELEGRAM_CHAT_RATE': '1000000'
+        })
+        import jio
+        jio._DYNAMODB_CLIENT = dynamodb  # type: ignore
+        cases = scenarios()
+        if args.updates:
+            cases['recorded'] = (lambda: None, recorded(args.updates))
+        for name, (setup, updates) in cases.items():
+            result = replay(dynamodb, telegram, setup, updates, args.iterations)
+            timings: Optional[str] = None if args.no_timings else 'p50=%.2fms p99=%.2fms' % (
+                result['p50'] * 1000, result['p99'] * 1000)
+            print('%-14s updates=%d dynamodb=%g [%s] telegram=%g [%s] webhook_replies=%g%s' % (
+                name, result['updates'], sum(result['dynamodb'].values()), breakdown(result['dynamodb']),
+                sum(result['telegram'].values()), breakdown(result['telegram']), result['webhook_replies'],
+                ' ' + timings if timings else ''))
+
+
+if __name__ == '__main__':
+    main()
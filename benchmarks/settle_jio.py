@@ -0,0 +1,90 @@
+import decimal
+import itertools
+import math
+import os
+import random
+import sys
+import timeit
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+
+from settlement import Split, aggregate, settle, summarise  # noqa: E402
+
+GST_RATE = decimal.Decimal(0.07)
+
+
+def legacy_close(orders, split, gst, delivery):
+    # the calculation Jio.close made before the settlement engine, without
+    # the message formatting
+    all_items = list(itertools.chain.from_iterable([order['items'] for order in orders.values()]))
+    all_items = [(item['item'], item['price']) for item in all_items]
+    Counter(all_items).items()
+    user_total = {}
+    user_gst = {}
+    user_delivery = {}
+    for user_id, user_order in orders.items():
+        if len(user_order['items']) == 0:
+            continue
+        user_total[user_id] = sum([item['price'] for item in user_order['items']])
+        user_gst[user_id] = math.ceil(user_total[user_id] * GST_RATE) if gst else 0
+    grand_total = sum(user_total.values())
+    for user_id, user_order in orders.items():
+        if len(user_order['items']) == 0:
+            continue
+        if split == Split.EQUALLY:
+            user_delivery[user_id] = math.ceil(delivery / len(user_total))
+        elif split == Split.WEIGHTED:
+            user_delivery[user_id] = math.ceil(delivery * (user_total[user_id] / grand_total))
+        else:
+            user_delivery[user_id] = 0
+    grand_total_gst = grand_total * GST_RATE
+    if gst:
+        grand_total += grand_total_gst
+    grand_total += delivery
+    paid = sum(user_total[user_id] + user_gst[user_id] + user_delivery[user_id] for user_id in user_total)
+    return paid, grand_total
+
+
+def build_orders(participants: int, items: int, price_type: type = int) -> dict:
+    random.seed(0)
+    menu = [('Item %d' % index, price_type(random.randrange(150, 1500, 10))) for index in range(200)]
+    orders = {}
+    for user_id in range(1, participants + 1):
+        order_items = [{'item': item, 'price': price} for item, price in random.choices(menu, k=items)]
+        counts, subtotal = aggregate(order_items)
+        orders[str(user_id)] = {
+            'firstname': 'User %d' % user_id,
+            'items': order_items,
+            'counts': counts,
+            'subtotal': subtotal
+        }
+    return orders
+
+
+def best_of(function, number: int = 20) -> float:
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def main():
+    participants, items = 500, 20
+    # boto3 reads numbers from dynamodb as decimals
+    for price_type in [int, decimal.Decimal]:
+        orders = build_orders(participants, items, price_type)
+        for split in Split:
+            legacy = best_of(lambda: legacy_close(orders, split, True, 300))
+            engine = best_of(lambda: settle(orders, split, True, 300))
+            engine_text = best_of(lambda: summarise(settle(orders, split, True, 300)))
+            paid, grand_total = legacy_close(orders, split, True, 300)
+            settlement = settle(orders, split, True, 300)
+            # both grand totals include a free delivery, which no user pays
+            free_delivery = 300 if split == Split.FREE else 0
+            print('%dx%d prices=%-7s split=%-8s legacy=%.2fms settle=%.2fms settle+summary=%.2fms '
+                  'overcharge legacy=%.2f cents engine=%d cents' % (
+                      participants, items, price_type.__name__, split.value, legacy * 1000, engine * 1000,
+                      engine_text * 1000, paid + free_delivery - grand_total,
+                      sum(user['total'] for user in settlement['users']) + free_delivery - settlement['total']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+import copy
+import re
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from codec import decode_item, encode_item
+
+# comparison operators of condition expressions
+COMPARATORS: dict[str, Callable[[Any, Any], bool]] = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b
+}
+TOKEN = re.compile(r'\s*(<>|<=|>=|[=<>(),.+\-\[\]]|[#:]?[A-Za-z_][A-Za-z0-9_]*|\d+)')
+# stands in for attributes that do not exist while evaluating expressions
+MISSING = object()
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class TransactionCanceledException(Exception):
+    def __init__(self, reasons: list[dict[str, str]]):
+        super().__init__('Transaction cancelled, please refer cancellation reasons for specific reasons')
+        self.response = {'CancellationReasons': reasons}
+
+
+class _Exceptions:
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    TransactionCanceledException = TransactionCanceledException
+
+
+class _Expression:
+    # recursive descent over the subset of dynamodb expressions the bot uses
+    def __init__(self, expression: str, names: dict[str, str], values: dict[str, Any]):
+        self.tokens = TOKEN.findall(expression)
+        self.position = 0
+        self.names = names
+        self.values = values
+
+    def matches(self, item: dict[str, Any]) -> bool:
+        self.position = 0
+        return self.condition(item)
+
+    def apply(self, item: dict[str, Any]):
+        self.position = 0
+        self.update(item)
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected: Optional[str] = None) -> str:
+        token = self.tokens[self.position]
+        if expected is not None and token.upper() != expected:
+            raise ValueError('expected %s, got %s' % (expected, token))
+        self.position += 1
+        return token
+
+    def path(self) -> list[Any]:
+        token = self.take()
+        path: list[Any] = [self.names.get(token, token)]
+        while self.peek() in ('.', '['):
+            if self.take() == '.':
+                token = self.take()
+                path.append(self.names.get(token, token))
+            else:
+                path.append(int(self.take()))
+                self.take(']')
+        return path
+
+    def operand(self, item: dict[str, Any]) -> Any:
+        token = self.take()
+        if token.startswith(':'):
+            return self.values[token]
+        if self.peek() == '(':
+            self.take('(')
+            if token == 'if_not_exists':
+                value = _get(item, self.path())
+                self.take(',')
+                default = self.operand(item)
+                self.take(')')
+                return default if value is MISSING else value
+            if token == 'list_append':
+                first = self.operand(item)
+                self.take(',')
+                second = self.operand(item)
+                self.take(')')
+                return first + second
+            if token == 'size':
+                value = _get(item, self.path())
+                self.take(')')
+                return len(value)
+            raise ValueError('unsupported function %s' % token)
+        self.position -= 1
+        return _get(item, self.path())
+
+    def value(self, item: dict[str, Any]) -> Any:
+        # operand, optionally followed by + or - operand in update expressions
+        value = self.operand(item)
+        if self.peek() in ('+', '-'):
+            sign = 1 if self.take() == '+' else -1
+            value = value + sign * self.operand(item)
+        return value
+
+    def condition(self, item: dict[str, Any]) -> bool:
+        result = self.conjunction(item)
+        while self.peek() and self.peek().upper() == 'OR':
+            self.take()
+            result = self.conjunction(item) or result
+        return result
+
+    def conjunction(self, item: dict[str, Any]) -> bool:
+        result = self.negation(item)
+        while self.peek() and self.peek().upper() == 'AND':
+            self.take()
+            result = self.negation(item) and result
+        return result
+
+    def negation(self, item: dict[str, Any]) -> bool:
+        if self.peek().upper() == 'NOT':
+            self.take()
+            return not self.negation(item)
+        if self.peek() == '(':
+            self.take()
+            result = self.condition(item)
+            self.take(')')
+            return result
+        token = self.peek()
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self.take()
+            self.take('(')
+            exists = _get(item, self.path()) is not MISSING
+            self.take(')')
+            return exists if token == 'attribute_exists' else not exists
+        left = self.operand(item)
+        comparator = self.take()
+        if comparator.upper() == 'BETWEEN':
+            low = self.operand(item)
+            self.take('AND')
+            high = self.operand(item)
+            return left is not MISSING and low <= left <= high
+        right = self.operand(item)
+        if left is MISSING or right is MISSING:
+            return comparator == '<>'
+        return COMPARATORS[comparator](left, right)
+
+    def update(self, item: dict[str, Any]):
+        while self.peek():
+            clause = self.take().upper()
+            while True:
+                path = self.path()
+                if clause == 'SET':
+                    self.take('=')
+                    _set(item, path, self.value(item))
+                elif clause == 'REMOVE':
+                    _remove(item, path)
+                elif clause == 'ADD':
+                    value = self.operand(item)
+                    current = _get(item, path)
+                    _set(item, path, value if current is MISSING else current + value)
+                else:
+                    raise ValueError('unsupported update clause %s' % clause)
+                if self.peek() != ',':
+                    break
+                self.take()
+
+
+def _get(item: dict[str, Any], path: list[Any]) -> Any:
+    value: Any = item
+    for part in path:
+        try:
+            value = value[part]
+        except (KeyError, IndexError, TypeError):
+            return MISSING
+    return value
+
+
+def _set(item: dict[str, Any], path: list[Any], value: Any):
+    parent = _get(item, path[:-1])
+    if parent is MISSING:
+        raise ValueError('the document path provided in the update expression is invalid for update')
+    if isinstance(parent, list) and path[-1] >= len(parent):
+        parent.append(value)
+    else:
+        parent[path[-1]] = value
+
+
+def _remove(item: dict[str, Any], path: list[Any]):
+    parent = _get(item, path[:-1])
+    if parent is not MISSING:
+        try:
+            del parent[path[-1]]
+        except (KeyError, IndexError):
+            pass
+
+
+class StubDynamoDB:
+    # in-process stand-in for the low-level dynamodb client, with a single
+    # table keyed on chat_id and timestamp and any number of global secondary
+    # indexes given as (hash, range) attribute names
+    exceptions = _Exceptions
+
+    def __init__(self, latency: float = 0, indexes: Optional[dict[str, tuple[str, str]]] = None):
+        self.latency = latency
+        self.indexes = indexes or {}
+        self.items: dict[tuple[int, int], dict[str, Any]] = {}
+        self.calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def reset(self, items: bool = False):
+        with self.lock:
+            self.calls = {}
+            if items:
+                self.items = {}
+
+    def _call(self, operation: str):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _key(key: dict[str, Any]) -> tuple[int, int]:
+        return int(key['chat_id']['N']), int(key['timestamp']['N'])
+
+    @staticmethod
+    def _check(item: dict[str, Any], kwargs: dict[str, Any]):
+        if 'ConditionExpression' in kwargs:
+            expression = _Expression(kwargs['ConditionExpression'], kwargs.get('ExpressionAttributeNames', {}),
+                                     decode_item(kwargs.get('ExpressionAttributeValues', {})))
+            if not expression.matches(item):
+                raise ConditionalCheckFailedException('The conditional request failed')
+
+    @staticmethod
+    def _response(**kwargs: Any) -> dict[str, Any]:
+        return dict(ResponseMetadata={'HTTPStatusCode': 200}, **kwargs)
+
+    def get_item(self, TableName: str, Key: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        self._call('GetItem')
+        item = self.items.get(self._key(Key))
+        if item is None:
+            return self._response()
+        return self._response(Item=encode_item(item))
+
+    def put_item(self, TableName: str, Item: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        self._call('PutItem')
+        key = self._key(Item)
+        with self.lock:
+            self._check(self.items.get(key, {}), kwargs)
+            self.items[key] = decode_item(Item)
+        return self._response()
+
+    def delete_item(self, TableName: str, Key: dict[str, Any], **kwargs: Any) -> dict[str, Any]:
+        self._call('DeleteItem')
+        key = self._key(Key)
+        with self.lock:
+            self._check(self.items.get(key, {}), kwargs)
+            self.items.pop(key, None)
+        return self._response()
+
+    def update_item(self, TableName: str, Key: dict[str, Any], UpdateExpression: str, **kwargs: Any) -> dict[str, Any]:
+        self._call('UpdateItem')
+        key = self._key(Key)
+        with self.lock:
+            current = self.items.get(key, {})
+            self._check(current, kwargs)
+            # updates apply to a copy so that a failed update changes nothing
+            item = copy.deepcopy(current) or decode_item(Key)
+            _Expression(UpdateExpression, kwargs.get('ExpressionAttributeNames', {}),
+                        decode_item(kwargs.get('ExpressionAttributeValues', {}))).apply(item)
+            self.items[key] = item
+        if kwargs.get('ReturnValues') == 'ALL_NEW':
+            return self._response(Attributes=encode_item(item))
+        return self._response()
+
+    def batch_write_item(self, RequestItems: dict[str, list[dict[str, Any]]], **kwargs: Any) -> dict[str, Any]:
+        self._call('BatchWriteItem')
+        with self.lock:
+            for requests in RequestItems.values():
+                for request in requests:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        self.items[self._key(item)] = decode_item(item)
+                    else:
+                        self.items.pop(self._key(request['DeleteRequest']['Key']), None)
+        return self._response(UnprocessedItems={})
+
+    def transact_write_items(self, TransactItems: list[dict[str, Any]], **kwargs: Any) -> dict[str, Any]:
+        self._call('TransactWriteItems')
+        keys = {self._key(params['Item'] if action == 'Put' else params['Key'])
+                for request in TransactItems for action, params in request.items()}
+        # rejected by dynamodb with a ValidationException
+        if len(TransactItems) > 100 or len(keys) < len(TransactItems):
+            raise ValueError('at most 100 actions on distinct items in a transaction')
+        with self.lock:
+            # every condition is checked before any write is applied
+            reasons = []
+            for request in TransactItems:
+                [(action, params)] = request.items()
+                key = self._key(params['Item'] if action == 'Put' else params['Key'])
+                try:
+                    self._check(self.items.get(key, {}), params)
+                    reasons.append({'Code': 'None'})
+                except ConditionalCheckFailedException:
+                    reasons.append({'Code': 'ConditionalCheckFailed'})
+            if any(reason['Code'] != 'None' for reason in reasons):
+                raise TransactionCanceledException(reasons)
+            for request in TransactItems:
+                [(action, params)] = request.items()
+                if action == 'Put':
+                    self.items[self._key(params['Item'])] = decode_item(params['Item'])
+                elif action == 'Delete':
+                    self.items.pop(self._key(params['Key']), None)
+                elif action == 'Update':
+                    key = self._key(params['Key'])
+                    item = self.items.get(key) or decode_item(params['Key'])
+                    _Expression(params['UpdateExpression'], params.get('ExpressionAttributeNames', {}),
+                                decode_item(params.get('ExpressionAttributeValues', {}))).apply(item)
+                    self.items[key] = item
+        return self._response()
+
+    def batch_get_item(self, RequestItems: dict[str, dict[str, Any]], **kwargs: Any) -> dict[str, Any]:
+        self._call('BatchGetItem')
+        responses = {}
+        for table, request in RequestItems.items():
+            keys = [self._key(key) for key in request['Keys']]
+            responses[table] = [encode_item(self.items[key]) for key in keys if key in self.items]
+        return self._response(Responses=responses, UnprocessedKeys={})
+
+    def query(self, TableName: str, KeyConditionExpression: str, **kwargs: Any) -> dict[str, Any]:
+        self._call('Query')
+        hash_name, range_name = self.indexes[kwargs['IndexName']] if 'IndexName' in kwargs else ('chat_id', 'timestamp')
+        expression = _Expression(KeyConditionExpression, kwargs.get('ExpressionAttributeNames', {}),
+                                 decode_item(kwargs.get('ExpressionAttributeValues', {})))
+        with self.lock:
+            # sparse indexes only hold items with both key attributes
+            items = [item for item in self.items.values()
+                     if hash_name in item and range_name in item and expression.matches(item)]
+        items.sort(key=lambda item: item[range_name], reverse=not kwargs.get('ScanIndexForward', True))
+        if 'ExclusiveStartKey' in kwargs:
+            start = decode_item(kwargs['ExclusiveStartKey'])
+            position = next(index for index, item in enumerate(items)
+                            if all(item.get(name) == value for name, value in start.items()))
+            items = items[position + 1:]
+        response: dict[str, Any] = {}
+        if 'Limit' in kwargs and len(items) > kwargs['Limit']:
+            items = items[:kwargs['Limit']]
+            last = items[-1]
+            response['LastEvaluatedKey'] = encode_item(
+                {name: last[name] for name in {'chat_id', 'timestamp', hash_name, range_name}})
+        if 'FilterExpression' in kwargs:
+            names = kwargs.get('ExpressionAttributeNames', {})
+            values = decode_item(kwargs.get('ExpressionAttributeValues', {}))
+            items = [item for item in items if _Expression(kwargs['FilterExpression'], names, values).matches(item)]
+        response['Items'] = [encode_item(item) for item in items]
+        response['Count'] = len(items)
+        return self._response(**response)
+
+    def scan(self, TableName: str, **kwargs: Any) -> dict[str, Any]:
+        # counted so that the replay harness shows any scan of the table
+        self._call('Scan')
+        with self.lock:
+            items = list(self.items.values())
+        if 'FilterExpression' in kwargs:
+            names = kwargs.get('ExpressionAttributeNames', {})
+            values = decode_item(kwargs.get('ExpressionAttributeValues', {}))
+            items = [item for item in items if _Expression(kwargs['FilterExpression'], names, values).matches(item)]
+        return self._response(Items=[encode_item(item) for item in items], Count=len(items))
+
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class StubTelegram:
+    # minimal bot api server that answers every method with ok after a delay
+    def __init__(self, latency: float = 0.05, rate_limit_every: int = 0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in separate writes
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                with stub.lock:
+                    stub.calls[method] = stub.calls.get(method, 0) + 1
+                    count = sum(stub.calls.values())
+                time.sleep(stub.latency)
+                if stub.rate_limit_every and count % stub.rate_limit_every == 0:
+                    status = 429
+                    body = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                            'parameters': {'retry_after': 1}}
+                else:
+                    status = 200
+                    body = {'ok': True, 'result': {'message_id': count}}
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+
+    def __enter__(self) -> 'StubTelegram':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
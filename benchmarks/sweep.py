@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'supper-bot'))
+
+from stub_dynamodb import StubDynamoDB  # noqa: E402
+from stub_telegram import StubTelegram  # noqa: E402
+
+JIO_TYPE = 'Al Amaan'
+
+
+def open_jios(dynamodb: StubDynamoDB, chats: int, participants: int, due: int):
+    # every chat opens a 15 minute jio, the first `due` of them 20 minutes ago
+    from jio import JIO_GST, JIO_SPLIT, Jio
+    now = int(time.time())
+    for chat in range(chats):
+        chat_id = -1000000000000 - chat
+        opened = now - 20 * 60 if chat < due else now
+        Jio.create(chat_id, 1, JIO_TYPE, 15, JIO_SPLIT[0], JIO_GST[0], 300)
+        jio = Jio.exists(chat_id)
+        for user_id in range(1, participants + 1):
+            jio.add_item(user_id, 'User %d' % user_id, 'Teh Ping', 150)
+        # backdate the jio, as if it had been opened earlier
+        header = dynamodb.items[(chat_id, 0)]
+        header['opened'] = opened
+        header['closes_at'] = opened + 15 * 60
+        for user_id in range(1, participants + 1):
+            dynamodb.items[(chat_id, -user_id)]['opened'] = opened
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Close due jios with the sweeper against in-process dynamodb and bot api stand-ins.')
+    parser.add_argument('--chats', type=int, default=200, help='chats with an open jio')
+    parser.add_argument('--due', type=int, default=50, help='of those, jios past their closing time')
+    parser.add_argument('--participants', type=int, default=5, help='users with an order in each jio')
+    args = parser.parse_args()
+
+    dynamodb = StubDynamoDB(indexes={'status-closes_at': ('status', 'closes_at')})
+    with StubTelegram() as telegram:
+        os.environ.update({
+            'BOT_TOKEN': 'sweep',
+            'TABLE_NAME': 'sweep',
+            'TELEGRAM_API_URL': telegram.url,
+            'TELEGRAM_GLOBAL_RATE': '1000000',
+            'TELEGRAM_CHAT_RATE': '1000000'
+        })
+        import jio
+        jio._DYNAMODB_CLIENT = dynamodb  # type: ignore
+        from outbox import drain
+        from sweeper import sweep
+        open_jios(dynamodb, args.chats, args.participants, args.due)
+        dynamodb.reset()
+        telegram.reset()
+        start = time.perf_counter()
+        closed = sweep()
+        # the messages are recorded in the outbox, as sent by the outbox function
+        sent = drain()
+        elapsed = time.perf_counter() - start
+        print('chats=%d due=%d closed=%d sent=%d time=%.1fms dynamodb=%s telegram=%s' % (
+            args.chats, args.due, closed, sent, elapsed * 1000,
+            ' '.join('%s=%d' % call for call in sorted(dynamodb.calls.items())),
+            ' '.join('%s=%d' % call for call in sorted(telegram.calls.items()))))
+        # a second sweep finds nothing left to close
+        dynamodb.reset()
+        print('second sweep closed=%d dynamodb=%s' % (
+            sweep(), ' '.join('%s=%d' % call for call in sorted(dynamodb.calls.items()))))
+
+
+if __name__ == '__main__':
+    main()
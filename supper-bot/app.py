@@ -1,16 +1,26 @@
 import enum
+import functools
 import json
 import logging
 import os
+import re
+import sys
+import time
 import traceback
-from typing import Any, TypedDict, Union
-
-from jio import JIO_DELIVERY, Jio, JIO_CLOSES, JIO_GST, JIO_SPLIT, JIO_TYPE
-from menu import get_menu_choices
-from telegram import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, Update, User, edit_message_text, send_message
+from typing import Any, Optional, Tuple, TypedDict, Union
+
+import callback_data
+import metrics
+from dedup import get_ledger
+from history import last_order
+from jio import JIO_DELIVERY, ItemTypeDef, Jio, JIO_CLOSES, JIO_GST, JIO_SPLIT, JIO_TYPE, UnitOfWork, get_favourites, get_history
+from menu import find_item, get_item_nodes, get_menu, get_menu_choices, search_menu, split_quantity
+from outbox import DeferredMessages, defer_message, defer_with
+from settlement import summarise
+from telegram import TELEGRAM_RETRY_WINDOW, WEBHOOK_REPLY, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, OutboundQueue, Outcome, Update, User, edit_message_text, escape_markdown, send_message
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
 
 
 class Command(enum.Enum):
@@ -20,10 +30,21 @@ class Command(enum.Enum):
     ADD_ITEM = 'additem'
     REMOVE_ITEM = 'removeitem'
     VIEW_ORDER = 'vieworder'
+    HISTORY = 'history'
+    REORDER = 'reorder'
     CANCEL = 'cancel'
+    # buttons that page through the choices of a menu node
+    ADD_ITEM_PAGE = 'additempage'
 
 
 MESSAGE_ADD_ITEM = 'Please choose an item:'
+MESSAGE_SEARCH_RESULTS = 'Items matching "%s":'
+MESSAGE_SEARCH_NO_RESULTS = 'No items match "%s". Please choose an item:'
+MESSAGE_ITEMS_ADDED = '*%s* added %s ($%.2f)'
+MESSAGE_ITEMS_NOT_FOUND = 'Could not find %s on the menu, nothing was added.'
+MESSAGE_NO_HISTORY = 'No Supper Jio has been closed in this chat yet.'
+MESSAGE_NO_LAST_ORDER = 'You have not ordered from %s in this chat before.'
+MESSAGE_ITEM_ALREADY_REMOVED = 'That item is no longer in your order.'
 MESSAGE_ERROR = 'Something went wrong.'
 MESSAGE_INVALID_COMMAND = 'Command not recognised.'
 MESSAGE_JIO_EXISTS = 'There is already a Supper Jio going on.\n\n/additem to add item to order\n/removeitem to remove item from order\n/vieworder to check order'
@@ -34,6 +55,30 @@ MESSAGE_NOT_JIO_STARTER = 'Sorry, only the person who started it can close the S
 MESSAGE_SEND_TO_GROUP = 'Please send your commands in a group chat!'
 MESSAGE_START_CHAT = 'Hi there, please start a chat with me first!'
 
+# seconds kept in reserve at the end of an invocation for sending queued edits
+DEADLINE_MARGIN = 0.5
+# dynamodb error codes, and reasons a transaction was cancelled, that a
+# redelivery of the update may get past
+TRANSIENT_ERROR_CODES = {
+    'ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded',
+    'InternalServerError', 'ServiceUnavailable', 'TransactionConflictException',
+    'TransactionInProgressException', 'ThrottlingError', 'TransactionConflict', 'ProvisionedThroughputExceeded'
+}
+# serialized keyboards of menu nodes and open jio flow steps kept per process
+KEYBOARD_CACHE_SIZE = int(os.environ.get('KEYBOARD_CACHE_SIZE', '256'))
+# choices shown at once, nodes with more are split into pages
+KEYBOARD_PAGE_SIZE = 10
+# items offered above the categories at the start of /additem
+FAVOURITES_SHOWN = 3
+# closed jios listed by /history
+HISTORY_SHOWN = 5
+# more of an item added with one tap after it has been added
+QUANTITY_CHOICES = [1, 2, 3, 5]
+# most of one item added at once
+MAX_QUANTITY = 20
+# an entry of a typed order such as '3x T30 Tomyam (Beef Mee)'
+ORDER_ENTRY = re.compile(r'(\d+)\s*x\s+(.+)', re.IGNORECASE)
+
 
 class FlowStep(TypedDict):
     message: str
@@ -46,7 +91,7 @@ OPEN_JIO_FLOW = [
         choices=JIO_TYPE
     ),
     FlowStep(
-        message='How long before closing the Supper Jio? (You will still need to tell me with /closejio)',
+        message='How long before closing the Supper Jio? (I will close it then, or close it earlier with /closejio)',
         choices=JIO_CLOSES
     ),
     FlowStep(
@@ -76,17 +121,15 @@ def open_jio(chat_id: int, user_id: int):
     if jio:
         send_message(chat_id, MESSAGE_JIO_EXISTS)
     else:
-        data_prefix = '%s_%s' % (Command.OPEN_JIO.value, chat_id)
-        flow_handler(data_prefix, user_id)
+        flow_handler(callback_data.encode(Command.OPEN_JIO.value, chat_id, []), user_id)
 
 
-def open_jio_send_messages(flow_state: list[str], user_id: int, message_id: int, first_name: str):
-    chat_id = int(flow_state[1])
-    type = JIO_TYPE[int(flow_state[2])]
+def open_jio_send_messages(chat_id: int, selections: list[int], user_id: int, message_id: int, first_name: str):
+    type = JIO_TYPE[selections[0]]
     delivery = JIO_DELIVERY
-    closes = JIO_CLOSES[int(flow_state[3])]
-    split = JIO_SPLIT[int(flow_state[4])]
-    gst = JIO_GST[int(flow_state[5])]
+    closes = JIO_CLOSES[selections[1]]
+    split = JIO_SPLIT[selections[2]]
+    gst = JIO_GST[selections[3]]
     jio = Jio.exists(chat_id)
     if jio:
         return edit_message_text(user_id, message_id, MESSAGE_JIO_EXISTS)
@@ -105,10 +148,14 @@ def close_jio(chat_id: int, user_id: int):
     if jio:
         if user_id == jio.starter_id:
             try:
-                order_summary, user_messages = jio.close()
-                send_message(chat_id, order_summary)
-                for message_user_id, message in user_messages.items():
-                    send_message(int(message_user_id), message)
+                settlement = jio.settle()
+                order_summary, user_messages = summarise(settlement)
+                # sent by the outbox consumer after the webhook is answered,
+                # recorded by the same transaction that closes the jio
+                messages = [(chat_id, order_summary)]
+                messages.extend((int(message_user_id), message) for message_user_id, message in user_messages.items())
+                if not defer_with(messages, lambda writes: jio.close(settlement, writes)):
+                    send_message(chat_id, MESSAGE_NO_JIO)
             except Exception:
                 traceback.print_exc()
                 send_message(chat_id, MESSAGE_ERROR)
@@ -118,11 +165,64 @@ def close_jio(chat_id: int, user_id: int):
         send_message(chat_id, MESSAGE_NO_JIO)
 
 
-def add_item(chat_id: int, user_id: int):
+def parse_order(text: str) -> Optional[list[tuple[int, str]]]:
+    # quantities and names of '3x T30 Tomyam (Beef Mee), 2x Teh Ping', or
+    # None for text that is not a typed order, such as a search query
+    entries = [entry.strip() for entry in text.split(',')]
+    if len(entries) == 1 and not ORDER_ENTRY.fullmatch(entries[0]):
+        return None
+    order: list[tuple[int, str]] = []
+    for entry in entries:
+        if not entry:
+            continue
+        match = ORDER_ENTRY.fullmatch(entry)
+        if match:
+            order.append((min(int(match.group(1)), MAX_QUANTITY), match.group(2)))
+        else:
+            order.append((1, entry))
+    return order
+
+
+def add_typed_order(jio: Jio, chat_id: int, _from: User, order: list[tuple[int, str]]):
+    # adds every entry with a single write, or nothing if any is not found
+    items: list[ItemTypeDef] = []
+    added: list[str] = []
+    missing: list[str] = []
+    for quantity, name in order:
+        found = find_item(jio.type, name)
+        if found is None:
+            missing.append('"%s"' % escape_markdown(name))
+            continue
+        if quantity:
+            items.extend([ItemTypeDef(item=found[0], price=found[1])] * quantity)
+            added.append('%dx %s' % (quantity, escape_markdown(found[0])))
+    if missing:
+        send_message(chat_id, MESSAGE_ITEMS_NOT_FOUND % ', '.join(missing))
+    elif items and jio.add_items(_from['id'], _from['first_name'], items):
+        send_message(chat_id, MESSAGE_ITEMS_ADDED % (
+            escape_markdown(_from['first_name']), ', '.join(added), sum(item['price'] for item in items)/100))
+
+
+def add_item(chat_id: int, _from: User, query: str = ''):
+    user_id = _from['id']
     jio = Jio.exists(chat_id)
     if jio:
-        prefix = '%s_%s' % (Command.ADD_ITEM.value, chat_id)
-        flow_handler(prefix, user_id)
+        order = parse_order(query) if query else None
+        if order is not None:
+            return add_typed_order(jio, chat_id, _from, order)
+        results = search_menu(jio.type, query) if query else []
+        if results:
+            # each result leads straight to the item, which is added on tap
+            kb = InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(
+                    text=label,
+                    callback_data=callback_data.encode(Command.ADD_ITEM.value, chat_id, path)
+                )] for label, path in results] + [[BUTTON_CANCEL]])
+            if send_message(user_id, MESSAGE_SEARCH_RESULTS % escape_markdown(query), kb) == Outcome.FORBIDDEN:
+                send_message(chat_id, MESSAGE_START_CHAT, KEYBOARD_START)
+        else:
+            prompt = MESSAGE_SEARCH_NO_RESULTS % escape_markdown(query) if query else MESSAGE_ADD_ITEM
+            flow_handler(callback_data.encode(Command.ADD_ITEM.value, chat_id, []), user_id, prompt=prompt)
     else:
         send_message(chat_id, MESSAGE_NO_JIO)
 
@@ -131,11 +231,10 @@ def remove_item(chat_id: int, user_id: int):
     jio = Jio.exists(chat_id=chat_id)
     if jio:
         if str(user_id) in jio.orders and jio.orders[str(user_id)]['items']:
-            prefix = '%s_%s' % (Command.REMOVE_ITEM.value, chat_id)
             item_names = ['%s - ($%.2f)' % (item['item'], item['price']/100)
                           for item in jio.orders[str(user_id)]['items']]
-            kb = get_inline_keyboard_markup(prefix, item_names)
-            if not send_message(user_id, 'Please choose an item to remove:', kb):
+            kb = get_inline_keyboard_markup(Command.REMOVE_ITEM.value, chat_id, [], item_names)
+            if send_message(user_id, 'Please choose an item to remove:', kb) == Outcome.FORBIDDEN:
                 send_message(chat_id, MESSAGE_START_CHAT, KEYBOARD_START)
         else:
             send_message(chat_id, 'You have no items to remove!')
@@ -151,21 +250,52 @@ def view_order(chat_id: int, user_id: int):
         send_message(chat_id, MESSAGE_NO_JIO)
 
 
-def flow_handler(data: str, user_id: int, message_id: int = 0, first_name: str = ''):
+def view_history(chat_id: int):
+    entries = get_history(chat_id)
+    if entries:
+        lines = ['Last Supper Jios:\n']
+        for entry in entries[:HISTORY_SHOWN]:
+            lines.append('*%s* - %s, %d %s, $%.2f' % (
+                time.strftime('%d %b', time.gmtime(entry['opened'])),
+                entry['type'],
+                len(entry['payers']),
+                'person' if len(entry['payers']) == 1 else 'people',
+                entry['total']/100
+            ))
+        lines.append('\n/reorder to add your last order to the current Supper Jio')
+        send_message(chat_id, '\n'.join(lines))
+    else:
+        send_message(chat_id, MESSAGE_NO_HISTORY)
+
+
+def reorder(chat_id: int, _from: User):
+    # adds the items of the user's last order from the same establishment,
+    # at today's prices
+    jio = Jio.exists(chat_id)
+    if jio:
+        order = last_order(get_history(chat_id), str(_from['id']), jio.type)
+        if order:
+            add_typed_order(jio, chat_id, _from, [(count, item) for item, count in order.items()])
+        else:
+            send_message(chat_id, MESSAGE_NO_LAST_ORDER % jio.type)
+    else:
+        send_message(chat_id, MESSAGE_NO_JIO)
+
+
+@metrics.timed('FlowHandler')
+def flow_handler(data: str, user_id: int, message_id: int = 0, first_name: str = '', prompt: str = MESSAGE_ADD_ITEM):
     try:
-        logger.debug('flow_handler data: %s' % data)
-        logger.debug('user_id: %s' % user_id)
-        logger.debug('message_id: %s' % message_id)
-        logger.debug('first_name: %s' % first_name)
-        flow_state = data.split('_')
-        command = flow_state[0]
+        logger.debug('flow_handler data: %s', data)
+        logger.debug('user_id: %s', user_id)
+        logger.debug('message_id: %s', message_id)
+        logger.debug('first_name: %s', first_name)
+        # chat_id is 0 for the cancel command, which does not have it attached
+        command, chat_id, selections = callback_data.decode(data)
+        metrics.set_property('Command', command)
         if command == Command.CANCEL.value:
             return edit_message_text(user_id, message_id, 'Cancelled!')
-        # cancel command does not have chat_id attached
-        chat_id = int(flow_state[1])
-        selections = [int(i) for i in flow_state[2:]
-                      ] if len(flow_state) > 2 else []
         stage = len(selections)
+        metrics.set_property('MenuDepth', stage)
         if command == Command.OPEN_JIO.value:
             jio = Jio.exists(chat_id)
             if jio:
@@ -175,76 +305,80 @@ def flow_handler(data: str, user_id: int, message_id: int = 0, first_name: str =
                 if stage == len(OPEN_JIO_FLOW):
                     # end of the openjio flow
                     open_jio_send_messages(
-                        flow_state, user_id, message_id, first_name)
+                        chat_id, selections, user_id, message_id, first_name)
                 else:
                     message = OPEN_JIO_FLOW[stage]['message']
-                    choices = OPEN_JIO_FLOW[stage]['choices']
+                    kb = get_keyboard(command, chat_id, tuple(selections))
                     if stage == 0:
-                        kb = get_inline_keyboard_markup(data, choices)
                         if message_id:  # user has went back to stage 0
                             edit_message_text(user_id, message_id, message, kb)
                         else:  # message_id = 0, i.e. initial openjio command
-                            if not send_message(user_id, message, kb):
+                            if send_message(user_id, message, kb) == Outcome.FORBIDDEN:
                                 send_message(
                                     chat_id, MESSAGE_START_CHAT, KEYBOARD_START)
                     else:
-                        kb = get_inline_keyboard_markup(
-                            data, choices, include_back=True)
                         edit_message_text(user_id, message_id, message, kb)
         elif command == Command.ADD_ITEM.value:
             jio = Jio.exists(chat_id)
             if jio:
-                choices, selection = get_menu_choices(selections)
+                choices, selection = get_menu_choices(jio.type, selections)
                 if stage == 0 and choices:  # initial message to add item
-                    kb = get_inline_keyboard_markup(data, choices)
+                    # one tap adds an item the user or the chat often orders
+                    favourites = get_item_nodes(jio.type, get_favourites(chat_id, user_id))[:FAVOURITES_SHOWN]
+                    kb = get_keyboard(command, chat_id, (), jio.type, favourites=favourites)
                     if message_id:  # user has went back to stage 0
                         edit_message_text(user_id, message_id,
                                           MESSAGE_ADD_ITEM, kb)
                     else:
-                        if not send_message(user_id, MESSAGE_ADD_ITEM, kb):
+                        if send_message(user_id, prompt, kb) == Outcome.FORBIDDEN:
                             send_message(
                                 chat_id, MESSAGE_START_CHAT, KEYBOARD_START)
                 else:
                     if selection:  # an item has been selected
                         item = selection[0]
                         price = selection[1]
-                        if jio.add_item(user_id, first_name, item, price):
-                            prefix = '%s_%s' % (
-                                Command.ADD_ITEM.value, chat_id)
-                            kb = InlineKeyboardMarkup(inline_keyboard=[[
-                                InlineKeyboardButton(
-                                    text='Add another item',
-                                    callback_data=prefix
-                                ),
-                                BUTTON_CANCEL
-                            ]])
+                        path, quantity = split_quantity(jio.type, selections)
+                        quantity = min(quantity, MAX_QUANTITY)
+                        if jio.add_items(user_id, first_name, [ItemTypeDef(item=item, price=price)] * quantity):
+                            kb = get_item_added_keyboard_markup(chat_id, path)
                             edit_message_text(
-                                user_id, message_id, 'Item added - %s ($%.2f)' % (item, price/100), kb)
+                                user_id, message_id, 'Item added - %dx %s ($%.2f)' % (quantity, item, quantity*price/100), kb)
                     elif choices:  # update message keyboard with menu choices
-                        kb = get_inline_keyboard_markup(
-                            data, choices, include_back=True)
+                        kb = get_keyboard(command, chat_id, tuple(selections), jio.type)
                         edit_message_text(user_id, message_id,
                                           MESSAGE_ADD_ITEM, kb)
             else:
                 edit_message_text(user_id, message_id, MESSAGE_NO_JIO_PRIVATE)
+        elif command == Command.ADD_ITEM_PAGE.value:
+            # the path of a menu node followed by the page to show
+            jio = Jio.exists(chat_id)
+            if jio:
+                kb = get_keyboard(Command.ADD_ITEM.value, chat_id, tuple(selections[:-1]), jio.type, selections[-1])
+                edit_message_text(user_id, message_id, MESSAGE_ADD_ITEM, kb)
+            else:
+                edit_message_text(user_id, message_id, MESSAGE_NO_JIO_PRIVATE)
         elif command == Command.REMOVE_ITEM.value:
             index = selections[0]
             jio = Jio.exists(chat_id)
             if jio:
                 if jio.remove_item(user_id, index):
                     return edit_message_text(user_id, message_id, text='Item removed!')
+                # a keyboard from before the item was removed
+                edit_message_text(user_id, message_id, MESSAGE_ITEM_ALREADY_REMOVED)
             else:
                 edit_message_text(user_id, message_id, MESSAGE_NO_JIO_PRIVATE)
         else:
-            logger.error('unhandled command: %s' % command)
+            logger.error('unhandled command: %s', command)
             edit_message_text(user_id, message_id, MESSAGE_ERROR)
     except Exception:
         traceback.print_exc()
         edit_message_text(user_id, message_id, MESSAGE_ERROR)
 
 
-def parse_command(command: str, chat_id: int, _from: User):
+@metrics.timed('ParseCommand')
+def parse_command(command: str, chat_id: int, _from: User, args: str = ''):
     user_id = _from['id']
+    metrics.set_property('Command', command)
     if command == Command.START.value:
         send_message(chat_id, MESSAGE_START_CHAT, KEYBOARD_START)
     elif command == Command.OPEN_JIO.value:
@@ -252,11 +386,15 @@ def parse_command(command: str, chat_id: int, _from: User):
     elif command == Command.CLOSE_JIO.value:
         close_jio(chat_id, user_id)
     elif command == Command.ADD_ITEM.value:
-        add_item(chat_id, user_id)
+        add_item(chat_id, _from, args)
     elif command == Command.REMOVE_ITEM.value:
         remove_item(chat_id, user_id)
     elif command == Command.VIEW_ORDER.value:
         view_order(chat_id, user_id)
+    elif command == Command.HISTORY.value:
+        view_history(chat_id)
+    elif command == Command.REORDER.value:
+        reorder(chat_id, _from)
     else:
         send_message(user_id, MESSAGE_INVALID_COMMAND)
 
@@ -277,18 +415,20 @@ def parse_update(update: Update):
                 for entity in entities:
                     if entity['type'] == 'bot_command':
                         command = extract_command(text, entity)
-                        logger.info('bot_command: %s' % command)
-                        parse_command(command, chat_id, _from)
+                        logger.info('bot_command: %s', command)
+                        # e.g. the search query of /additem tomyam
+                        args = text[entity['offset'] + entity['length']:].strip()
+                        parse_command(command, chat_id, _from, args)
                         # process only one bot command
                         break
             elif 'left_chat_member' in message:
                 user = message['left_chat_member']
                 if user['is_bot'] and user['id'] == int(os.environ['BOT_ID']):
-                    send_message(int(os.environ['BOT_OWNER']), 'Removed from chat: %s' % chat_title)
+                    notify_owner('Removed from chat: %s' % chat_title)
             elif 'new_chat_members' in message:
                 for user in message['new_chat_members']:
                     if user['is_bot'] and user['id'] == int(os.environ['BOT_ID']):
-                        send_message(int(os.environ['BOT_OWNER']), 'Added to chat: %s' % chat_title)
+                        notify_owner('Added to chat: %s' % chat_title)
                         break
     elif 'callback_query' in update:
         callback_query: CallbackQuery = update['callback_query']
@@ -300,6 +440,19 @@ def parse_update(update: Update):
             flow_handler(data, user_id, message_id, first_name)
 
 
+def needs_processing(update: Update) -> bool:
+    # whether parse_update acts on the update, others are acknowledged
+    # without loading boto3 or requests
+    if 'message' in update:
+        message = update['message']
+        if message['chat']['type'] == 'private':
+            return True
+        if 'entities' in message and 'from' in message and 'text' in message:
+            return any(entity['type'] == 'bot_command' for entity in message['entities'])
+        return 'left_chat_member' in message or 'new_chat_members' in message
+    return 'callback_query' in update
+
+
 def extract_command(text: str, entity: MessageEntity) -> str:
     command = text[entity['offset']:entity['offset'] + entity['length']]
     # strip bot name and leading slash
@@ -308,20 +461,42 @@ def extract_command(text: str, entity: MessageEntity) -> str:
     return command
 
 
-def get_inline_keyboard_markup(data_prefix: str, choices: Union[list[str], list[int]], include_cancel: bool = True, include_back: bool = False) -> InlineKeyboardMarkup:
+def get_inline_keyboard_markup(command: str, chat_id: int, path: list[int], choices: Union[list[str], list[int]], include_cancel: bool = True, include_back: bool = False, page: int = 0) -> InlineKeyboardMarkup:
     buttons: list[list[InlineKeyboardButton]] = []
-    for index, choice in enumerate(choices):
+    # only menu nodes are paged, other keyboards show all of their choices
+    paged = command == Command.ADD_ITEM.value and len(choices) > KEYBOARD_PAGE_SIZE
+    start = page * KEYBOARD_PAGE_SIZE if paged else 0
+    stop = start + KEYBOARD_PAGE_SIZE if paged else len(choices)
+    for index in range(start, min(stop, len(choices))):
         button = InlineKeyboardButton(
-            text=str(choice),
-            callback_data='%s_%s' % (data_prefix, index)
+            text=str(choices[index]),
+            callback_data=callback_data.encode(command, chat_id, path + [index])
         )
         buttons.append([button])
+    if paged:
+        row: list[InlineKeyboardButton] = []
+        if page:
+            row.append(InlineKeyboardButton(
+                text='Previous',
+                callback_data=callback_data.encode(Command.ADD_ITEM_PAGE.value, chat_id, path + [page - 1])
+            ))
+        if stop < len(choices):
+            row.append(InlineKeyboardButton(
+                text='Next',
+                callback_data=callback_data.encode(Command.ADD_ITEM_PAGE.value, chat_id, path + [page + 1])
+            ))
+        buttons.append(row)
     if include_back:
-        prefix_parts = data_prefix.split('_')
-        if len(prefix_parts) > 2:
+        if path:
+            if command == Command.ADD_ITEM.value and path[-1] >= KEYBOARD_PAGE_SIZE:
+                # back to the page of the parent that holds this node
+                data = callback_data.encode(
+                    Command.ADD_ITEM_PAGE.value, chat_id, path[:-1] + [path[-1] // KEYBOARD_PAGE_SIZE])
+            else:
+                data = callback_data.encode(command, chat_id, path[:-1])
             button = InlineKeyboardButton(
                 text='Back',
-                callback_data='_'.join(prefix_parts[:-1])
+                callback_data=data
             )
             buttons.append([button])
     if include_cancel:
@@ -329,13 +504,124 @@ def get_inline_keyboard_markup(data_prefix: str, choices: Union[list[str], list[
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def lambda_handler(event: dict[str, Any], context: dict[str, Any]):
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_keyboard(command: str, chat_id: int, path: Tuple[int, ...], jio_type: str = '', page: int = 0, favourites: Tuple[int, ...] = ()) -> str:
+    # serialized reply_markup of an open jio flow step or a page of a menu
+    # node, which only depend on the arguments; the members of a group
+    # tapping through the same menu share them
+    if command == Command.OPEN_JIO.value:
+        choices: Union[list[str], list[int]] = OPEN_JIO_FLOW[len(path)]['choices']
+    else:
+        choices = get_menu_choices(jio_type, list(path))[0] or []
+    markup = get_inline_keyboard_markup(command, chat_id, list(path), choices, include_back=True, page=page)
+    if favourites:
+        # menu items given by node, which lead straight to the item
+        menu = get_menu(jio_type)
+        markup['inline_keyboard'][:0] = [[InlineKeyboardButton(
+            text='\u2605 %s' % menu.labels[node],
+            callback_data=callback_data.encode(command, chat_id, menu.path(node))
+        )] for node in favourites]
+    return json.dumps(markup)
+
+
+def get_item_added_keyboard_markup(chat_id: int, path: list[int]) -> InlineKeyboardMarkup:
+    # adds more of the item just added, or goes back to the top of the menu
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text='+%d' % quantity,
+            callback_data=callback_data.encode(Command.ADD_ITEM.value, chat_id, path + [quantity])
+        ) for quantity in QUANTITY_CHOICES],
+        [InlineKeyboardButton(
+            text='Add another item',
+            callback_data=callback_data.encode(Command.ADD_ITEM.value, chat_id, [])
+        ), BUTTON_CANCEL]
+    ])
+
+
+def notify_owner(text: str):
+    # BOT_OWNER is optional, without it the bot joins and leaves chats quietly
+    if 'BOT_OWNER' in os.environ:
+        defer_message(int(os.environ['BOT_OWNER']), text)
+
+
+def transient(error: Exception) -> bool:
+    # whether processing the update again may succeed: dynamodb throttling,
+    # server errors and transaction conflicts, or a connection error
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        # botocore's ClientError and the exceptions of the client
+        codes = {response.get('Error', {}).get('Code')}
+        codes.update(reason.get('Code') for reason in response.get('CancellationReasons', []))
+        return bool(codes & TRANSIENT_ERROR_CODES) or response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    # not imported by updates that have not used dynamodb
+    botocore_exceptions = sys.modules.get('botocore.exceptions')
+    return botocore_exceptions is not None and isinstance(
+        error, (botocore_exceptions.ConnectionError, botocore_exceptions.HTTPClientError))
+
+
+def process_update(update: Update, deadline: float, webhook_reply: bool = WEBHOOK_REPLY) -> Optional[dict[str, Any]]:
+    # handles an update and sends its replies by the deadline, a
+    # time.monotonic() value; returns the message edit to answer a webhook
+    # with, if any
+    if not needs_processing(update):
+        return None
+    update_id = update['update_id']
+    # acknowledge updates redelivered by telegram while they are processed or
+    # after they were, but not after an invocation that died before the end
+    # of its lease, i.e. the time left until lambda times out
+    if not get_ledger().claim(update_id, deadline - time.monotonic() + DEADLINE_MARGIN):
+        logger.info('update %d already processed', update_id)
+        return None
+    # Jio.exists() hits dynamodb at most once per chat within an update
+    unit_of_work = UnitOfWork()
+    outbound_queue = OutboundQueue(deadline, webhook_reply)
+    # slow follow-ups such as the /closejio fan-out go to the outbox instead
+    deferred_messages = DeferredMessages(update_id)
     try:
-        update = json.loads(event['body'])
-        parse_update(update)
-    except Exception:
-        logger.info('Error while processing event: %s' % event)
-        traceback.print_exc()
+        with unit_of_work, outbound_queue, deferred_messages:
+            parse_update(update)
+        deferred_messages.record()
+    except Exception as e:
+        if transient(e):
+            logger.info('Error while processing update: %s', update)
+            # processed again when telegram redelivers it, which it does as
+            # lambda_handler answers with an error
+            get_ledger().release(update_id)
+            raise
+        # fails the same way every time, e.g. a bug, so it is not redelivered
+        logger.exception('Failed to process update: %s', update)
+    get_ledger().complete(update_id)
+    logger.info('dynamodb round trips: %d, coalesced edits: %d', unit_of_work.round_trips, outbound_queue.coalesced)
+    metrics.set_property('CoalescedEdits', outbound_queue.coalesced)
+    body = outbound_queue.flush()
+    metrics.set_property('WebhookReply', body is not None)
+    return body
+
+
+def lambda_handler(event: dict[str, Any], context: Any):
+    # leave time to send the queued message edits before lambda times out
+    if context:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+    else:
+        deadline = time.monotonic() + TELEGRAM_RETRY_WINDOW
+    body = None
+    with metrics.UpdateMetrics():
+        try:
+            body = process_update(json.loads(event['body']), deadline)
+        except Exception:
+            logger.info('Error while processing event: %s', event)
+            traceback.print_exc()
+            # telegram redelivers the update
+            return {
+                "statusCode": 500,
+                "body": None
+            }
+    if body:
+        return {
+            "statusCode": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(body)
+        }
     return {
         "statusCode": 200,
         "body": None
@@ -0,0 +1,103 @@
+import base64
+import string
+from typing import Tuple
+
+# telegram rejects buttons with longer callback_data
+CALLBACK_DATA_LIMIT = 64
+# first character of compact callback_data, legacy callback_data always
+# starts with a command name
+VERSION = '1'
+# first character of the text form of compact callback_data, used when every
+# menu index fits in one character, which decodes without base64
+TEXT_VERSION = '2'
+# command tag in the high nibble of the first byte, append only as tags are
+# kept in buttons that are already out in the wild
+COMMANDS = ('cancel', 'openjio', 'additem', 'removeitem', 'additempage')
+COMMAND_TAGS = {command: tag for tag, command in enumerate(COMMANDS)}
+# menu indices from this value on take three bytes instead of one
+WIDE_INDEX = 0xff
+# command tags and menu indices of the text form, one character each
+TEXT_CHARS = string.digits + string.ascii_letters + '-_'
+TEXT_VALUES = {char: value for value, char in enumerate(TEXT_CHARS)}
+TEXT_COMMANDS = {TEXT_CHARS[tag]: command for tag, command in enumerate(COMMANDS)}
+# digits of the chat id in the text form, which int(..., 36) reads back
+BASE36_DIGITS = string.digits + string.ascii_lowercase
+
+
+def encode(command: str, chat_id: int, path: list[int]) -> str:
+    if all(index < len(TEXT_CHARS) for index in path):
+        data = _encode_text(command, chat_id, path)
+    else:
+        data = _encode_binary(command, chat_id, path)
+    if len(data) > CALLBACK_DATA_LIMIT:
+        raise ValueError('callback_data longer than %d bytes: %s' % (CALLBACK_DATA_LIMIT, data))
+    return data
+
+
+def _to_base36(number: int) -> str:
+    digits: list[str] = []
+    magnitude = abs(number)
+    while True:
+        magnitude, digit = divmod(magnitude, 36)
+        digits.append(BASE36_DIGITS[digit])
+        if not magnitude:
+            break
+    return ('-' if number < 0 else '') + ''.join(reversed(digits))
+
+
+def _encode_text(command: str, chat_id: int, path: list[int]) -> str:
+    # version, command tag, one character per menu level, '.' and the chat
+    # id in base 36; e.g. '223102.-cryl7kya', 16 characters for a supergroup
+    # 4 levels deep like the binary form
+    return '%s%s%s.%s' % (TEXT_VERSION, TEXT_CHARS[COMMAND_TAGS[command]],
+                          ''.join(TEXT_CHARS[index] for index in path), _to_base36(chat_id))
+
+
+def _encode_binary(command: str, chat_id: int, path: list[int]) -> str:
+    # version + base64url of: command tag and chat id length in one byte, the
+    # chat id as a signed big-endian integer, one byte per menu level; e.g. 16
+    # characters for a supergroup 4 levels deep against 30 for the legacy
+    # 'additem_-1001234567890_3_1_0_2'
+    length = (chat_id.bit_length() + 8) // 8
+    out = bytearray((COMMAND_TAGS[command] << 4 | length,))
+    out += chat_id.to_bytes(length, 'big', signed=True)
+    for index in path:
+        if index < WIDE_INDEX:
+            out.append(index)
+        else:
+            out.append(WIDE_INDEX)
+            out += index.to_bytes(2, 'big')
+    return VERSION + base64.urlsafe_b64encode(out).rstrip(b'=').decode()
+
+
+def decode(data: str) -> Tuple[str, int, list[int]]:
+    # returns the command, chat id and menu path, the chat id is 0 for
+    # buttons without one such as cancel
+    if data.startswith(TEXT_VERSION):
+        path, _, chat_id = data[2:].partition('.')
+        return TEXT_COMMANDS[data[1]], int(chat_id, 36), [TEXT_VALUES[char] for char in path]
+    if not data.startswith(VERSION):
+        return _decode_legacy(data)
+    payload = base64.urlsafe_b64decode(data[1:] + '=' * (-(len(data) - 1) % 4))
+    length = payload[0] & 0xf
+    chat_id = int.from_bytes(payload[1:length + 1], 'big', signed=True)
+    levels = payload[length + 1:]
+    if WIDE_INDEX not in levels:
+        return COMMANDS[payload[0] >> 4], chat_id, list(levels)
+    path: list[int] = []
+    position = 0
+    while position < len(levels):
+        if levels[position] == WIDE_INDEX:
+            path.append(int.from_bytes(levels[position + 1:position + 3], 'big'))
+            position += 3
+        else:
+            path.append(levels[position])
+            position += 1
+    return COMMANDS[payload[0] >> 4], chat_id, path
+
+
+def _decode_legacy(data: str) -> Tuple[str, int, list[int]]:
+    # 'command_chatid_index_index...' as sent before compact callback_data
+    parts = data.split('_')
+    chat_id = int(parts[1]) if len(parts) > 1 else 0
+    return parts[0], chat_id, [int(index) for index in parts[2:]]
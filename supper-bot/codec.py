@@ -0,0 +1,77 @@
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from jio import ItemTypeDef, OrderListTypeDef
+
+# attribute values of the low-level dynamodb client, e.g. {'N': '350'}
+AttributeValue = dict[str, Any]
+
+
+def encode(value: Any) -> AttributeValue:
+    # the jio schema only stores integers, strings, lists and maps, and the
+    # compressed history of a chat as binary
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, int):
+        return {'N': str(value)}
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bytes):
+        return {'B': value}
+    if isinstance(value, dict):
+        return {'M': {key: encode(item) for key, item in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [encode(item) for item in value]}
+    if value is None:
+        return {'NULL': True}
+    raise TypeError('cannot encode %r as a dynamodb attribute value' % (value,))
+
+
+def encode_item(item: dict[str, Any]) -> dict[str, AttributeValue]:
+    # also encodes ExpressionAttributeValues and keys
+    return {key: encode(value) for key, value in item.items()}
+
+
+def decode(value: AttributeValue) -> Any:
+    # generic fallback, numbers are read as ints rather than decimals
+    [(kind, data)] = value.items()
+    if kind == 'S':
+        return data
+    if kind == 'N':
+        return int(data)
+    if kind == 'M':
+        return {key: decode(item) for key, item in data.items()}
+    if kind == 'L':
+        return [decode(item) for item in data]
+    if kind in ('BOOL', 'B'):
+        return data
+    if kind == 'NULL':
+        return None
+    raise TypeError('cannot decode dynamodb attribute value of type %s' % kind)
+
+
+def decode_item(item: dict[str, AttributeValue]) -> dict[str, Any]:
+    return {key: decode(value) for key, value in item.items()}
+
+
+def decode_items(value: AttributeValue) -> list['ItemTypeDef']:
+    # the items of an order, without going through decode() for every field
+    items: list[Any] = []
+    for entry in value['L']:
+        fields = entry['M']
+        items.append({'item': fields['item']['S'], 'price': int(fields['price']['N'])})
+    return items
+
+
+def decode_counts(value: AttributeValue) -> dict[str, int]:
+    return {name: int(count['N']) for name, count in value['M'].items()}
+
+
+def decode_order(item: dict[str, AttributeValue]) -> 'OrderListTypeDef':
+    # an order item, or an order in the orders map of a jio archived before
+    # orders were left in their own items
+    order: Any = {'firstname': item['firstname']['S'], 'items': decode_items(item['items'])}
+    if 'counts' in item:
+        order['counts'] = decode_counts(item['counts'])
+        order['subtotal'] = int(item['subtotal']['N'])
+    return order
@@ -0,0 +1,112 @@
+import logging
+import math
+import os
+import threading
+import time
+from typing import Optional, Protocol
+
+from codec import encode_item
+from jio import conditional_check_failed, get_client, get_table_name
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# 'dynamodb' in lambda, 'memory' for local runs and tests
+DEDUP_BACKEND = os.environ.get('DEDUP_BACKEND', 'dynamodb')
+# telegram stops redelivering an update well within a day
+DEDUP_TTL = 24 * 60 * 60
+# processed update ids are kept in the table under this chat id, which is
+# never the id of a real chat
+DEDUP_CHAT_ID = 0
+# seconds between removals of expired update ids from memory
+DEDUP_EVICT_INTERVAL = 60.0
+
+
+class UpdateLedger(Protocol):
+    # an update is claimed for the seconds it may take to process, so that a
+    # redelivery after the processing died, e.g. when lambda timed out, is
+    # processed again, and completed once processed
+    def claim(self, update_id: int, lease: float) -> bool:
+        ...
+
+    def complete(self, update_id: int):
+        ...
+
+    def release(self, update_id: int):
+        ...
+
+
+class DynamoDBLedger:
+    # records update ids with a conditional put, expired by dynamodb ttl
+    @timed('Dedup')
+    def claim(self, update_id: int, lease: float) -> bool:
+        now = int(time.time())
+        try:
+            get_client().put_item(
+                TableName=get_table_name(),
+                Item=encode_item({
+                    'chat_id': DEDUP_CHAT_ID,
+                    'timestamp': update_id,
+                    'expires': now + math.ceil(lease)
+                }),
+                # ttl deletes expired items lazily, so check expiry as well
+                ConditionExpression='attribute_not_exists(chat_id) OR expires < :now',
+                ExpressionAttributeValues=encode_item({':now': now})
+            )
+            return True
+        except conditional_check_failed():
+            return False
+
+    @timed('Dedup')
+    def complete(self, update_id: int):
+        get_client().update_item(
+            TableName=get_table_name(),
+            Key=encode_item({'chat_id': DEDUP_CHAT_ID, 'timestamp': update_id}),
+            UpdateExpression='SET expires = :expires',
+            ExpressionAttributeValues=encode_item({':expires': int(time.time()) + DEDUP_TTL})
+        )
+
+    @timed('Dedup')
+    def release(self, update_id: int):
+        get_client().delete_item(TableName=get_table_name(), Key=encode_item({
+            'chat_id': DEDUP_CHAT_ID,
+            'timestamp': update_id
+        }))
+
+
+class MemoryLedger:
+    # shared by the worker threads of polling.py
+    def __init__(self):
+        self.expires: dict[int, float] = {}
+        self.evicted = time.time()
+        self.lock = threading.Lock()
+
+    def claim(self, update_id: int, lease: float) -> bool:
+        now = time.time()
+        with self.lock:
+            if now - self.evicted > DEDUP_EVICT_INTERVAL:
+                self.expires = {update: expires for update, expires in self.expires.items() if expires > now}
+                self.evicted = now
+            if self.expires.get(update_id, 0) > now:
+                return False
+            self.expires[update_id] = now + lease
+            return True
+
+    def complete(self, update_id: int):
+        with self.lock:
+            self.expires[update_id] = time.time() + DEDUP_TTL
+
+    def release(self, update_id: int):
+        with self.lock:
+            self.expires.pop(update_id, None)
+
+
+_LEDGER: Optional[UpdateLedger] = None
+
+
+def get_ledger() -> UpdateLedger:
+    global _LEDGER
+    if _LEDGER is None:
+        _LEDGER = MemoryLedger() if DEDUP_BACKEND == 'memory' else DynamoDBLedger()
+    return _LEDGER
@@ -0,0 +1,135 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, TypedDict
+
+from telegram import RETRYABLE_OUTCOMES, TELEGRAM_POOL_SIZE, Outcome, classify, message_data, post, retry_after
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))  # messages per second
+CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))  # messages per second per chat
+DISPATCH_WORKERS = TELEGRAM_POOL_SIZE
+DISPATCH_ATTEMPTS = 3
+# give up instead of waiting longer than this for a rate limit to lift
+DISPATCH_MAX_WAIT = 1.0
+# seconds between removals of the buckets of chats that have been idle long
+# enough to refill, so a long-running process does not keep one per chat
+# it ever sent to
+DISPATCH_EVICT_INTERVAL = 60.0
+
+
+class DispatchResult(TypedDict):
+    chat_id: int
+    ok: bool
+    status_code: int  # 0 if the bot api could not be reached
+    attempts: int
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # takes a token and returns the seconds to wait before using it, the
+        # bucket goes into debt so that waiting callers queue up in order
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def full(self) -> bool:
+        # whether the bucket is as good as a new one
+        with self.lock:
+            self._refill()
+            return self.tokens >= self.capacity
+
+    def refund(self):
+        # returns a token taken by reserve() that was not used
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def block(self, seconds: float):
+        # the next reserve() waits for at least the given time, e.g. after a
+        # 429 with retry_after
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class Dispatcher:
+    # sends independent messages concurrently within telegram's rate limits
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE, workers: int = DISPATCH_WORKERS):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.evicted = time.monotonic()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self.lock:
+            now = time.monotonic()
+            if now - self.evicted > DISPATCH_EVICT_INTERVAL:
+                self.chat_buckets = {chat: bucket for chat, bucket in self.chat_buckets.items() if not bucket.full()}
+                self.evicted = now
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+            return self.chat_buckets[chat_id]
+
+    def _send(self, chat_id: int, text: str) -> DispatchResult:
+        data = message_data(chat_id, text)
+        chat_bucket = self._chat_bucket(chat_id)
+        status_code = 0
+        attempts = 0
+        while attempts < DISPATCH_ATTEMPTS:
+            wait = max(self.global_bucket.reserve(), chat_bucket.reserve())
+            if wait > DISPATCH_MAX_WAIT:
+                # otherwise every message given up on leaves the chat in more
+                # debt, and the next attempt to send to it waits longer still
+                self.global_bucket.refund()
+                chat_bucket.refund()
+                break
+            time.sleep(wait)
+            attempts += 1
+            response = post('sendMessage', data)
+            status_code = response.status_code if response is not None else 0
+            outcome = classify(response)
+            if outcome not in RETRYABLE_OUTCOMES:
+                break
+            if outcome == Outcome.RATE_LIMITED:
+                wait = retry_after(response)
+                logger.info('rate limited for chat %d, retry after %ds', chat_id, wait)
+                chat_bucket.block(wait)
+        return DispatchResult(chat_id=chat_id, ok=status_code == 200, status_code=status_code, attempts=attempts)
+
+    def send_messages(self, messages: list[Tuple[int, str]]) -> list[DispatchResult]:
+        # run in the context of the caller, e.g. to record metrics of its update
+        futures = [self.executor.submit(contextvars.copy_context().run, self._send, chat_id, text)
+                   for chat_id, text in messages]
+        return [future.result() for future in futures]
+
+
+_DISPATCHER: Optional[Dispatcher] = None
+
+
+def get_dispatcher() -> Dispatcher:
+    global _DISPATCHER
+    if _DISPATCHER is None:
+        _DISPATCHER = Dispatcher()
+    return _DISPATCHER
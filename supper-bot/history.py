@@ -0,0 +1,83 @@
+import json
+import zlib
+from typing import TYPE_CHECKING, Any, Optional, TypedDict
+
+if TYPE_CHECKING:
+    from jio import OrderListTypeDef
+    from settlement import Settlement
+
+# closed jios kept in the history of a chat, newest first; each takes a few
+# hundred bytes compressed, well below the 400KB item limit
+HISTORY_LENGTH = 20
+
+
+class Payer(TypedDict):
+    user_id: str
+    firstname: str
+    total: int
+    # item -> quantity
+    items: dict[str, int]
+
+
+class HistoryEntry(TypedDict):
+    opened: int
+    type: str
+    total: int
+    items: dict[str, int]
+    payers: list[Payer]
+
+
+def entry(opened: int, type: str, settlement: 'Settlement', orders: dict[str, 'OrderListTypeDef']) -> HistoryEntry:
+    # what is kept of a closed jio: the totals, the items and who paid what
+    return HistoryEntry(
+        opened=opened,
+        type=type,
+        total=settlement['total'],
+        items=settlement['items'],
+        payers=[Payer(
+            user_id=user['user_id'],
+            firstname=user['firstname'],
+            total=user['total'],
+            items=orders[user['user_id']]['counts']
+        ) for user in settlement['users']]
+    )
+
+
+def encode(entries: list[HistoryEntry]) -> bytes:
+    # positional lists rather than maps, so field names are not repeated in
+    # every entry, then deflated; item names recur across jios of a chat and
+    # compress well
+    compact = [
+        [e['opened'], e['type'], e['total'], e['items'],
+         [[p['user_id'], p['firstname'], p['total'], p['items']] for p in e['payers']]]
+        for e in entries[:HISTORY_LENGTH]
+    ]
+    return zlib.compress(json.dumps(compact, separators=(',', ':')).encode(), 9)
+
+
+def decode(data: Optional[bytes]) -> list[HistoryEntry]:
+    if not data:
+        return []
+    compact: list[Any] = json.loads(zlib.decompress(data))
+    return [
+        HistoryEntry(opened=opened, type=type, total=total, items=items, payers=[
+            Payer(user_id=user_id, firstname=firstname, total=payer_total, items=payer_items)
+            for user_id, firstname, payer_total, payer_items in payers
+        ])
+        for opened, type, total, items, payers in compact
+    ]
+
+
+def append(data: Optional[bytes], new: HistoryEntry) -> bytes:
+    return encode([new] + decode(data))
+
+
+def last_order(entries: list[HistoryEntry], user_id: str, type: str) -> Optional[dict[str, int]]:
+    # the items the user ordered in the latest jio of the same establishment
+    for e in entries:
+        if e['type'] != type:
+            continue
+        for payer in e['payers']:
+            if payer['user_id'] == user_id:
+                return payer['items']
+    return None
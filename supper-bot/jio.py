@@ -1,18 +1,72 @@
-import decimal
-import itertools
-import math
+import logging
 import os
 import time
-from collections import Counter
-from typing import List, Literal, Tuple, TypedDict
+from contextvars import ContextVar, Token
+from typing import TYPE_CHECKING, Any, Callable, List, Literal, Optional, Sequence, Tuple, TypedDict
 
-import boto3
-from boto3.dynamodb.conditions import Attr, Key
+import history
+from codec import AttributeValue, decode_order, encode_item
+from history import HistoryEntry
+from menu import MENU_FILES
+from metrics import timed
+from settlement import Settlement, Split, aggregate, settle
 
-from mypy_boto3_dynamodb.service_resource import DynamoDBServiceResource
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb.client import DynamoDBClient
+    from mypy_boto3_dynamodb.service_resource import DynamoDBServiceResource, Table
 
-DYNAMODB_RESOURCE: DynamoDBServiceResource = boto3.resource('dynamodb')
-TABLE = DYNAMODB_RESOURCE.Table(os.environ['TABLE_NAME'])
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# created on first use, as importing boto3 dominates cold starts
+_DYNAMODB_CLIENT: Optional['DynamoDBClient'] = None
+_DYNAMODB_RESOURCE: Optional['DynamoDBServiceResource'] = None
+_TABLE: Optional['Table'] = None
+
+
+def get_client() -> 'DynamoDBClient':
+    # the bot reads and writes through the low-level client with codec.py,
+    # which skips the resource layer's conversion of every number to Decimal
+    global _DYNAMODB_CLIENT
+    if _DYNAMODB_CLIENT is None:
+        import boto3
+        _DYNAMODB_CLIENT = boto3.client('dynamodb')
+    return _DYNAMODB_CLIENT
+
+
+def get_resource() -> 'DynamoDBServiceResource':
+    global _DYNAMODB_RESOURCE
+    if _DYNAMODB_RESOURCE is None:
+        import boto3
+        _DYNAMODB_RESOURCE = boto3.resource('dynamodb')
+    return _DYNAMODB_RESOURCE
+
+
+def get_table() -> 'Table':
+    # for scripts such as migrate.py
+    global _TABLE
+    if _TABLE is None:
+        _TABLE = get_resource().Table(get_table_name())
+    return _TABLE
+
+
+def get_table_name() -> str:
+    return os.environ['TABLE_NAME']
+
+
+def conditional_check_failed() -> type:
+    return get_client().exceptions.ConditionalCheckFailedException
+
+
+def transaction_canceled() -> type:
+    return get_client().exceptions.TransactionCanceledException
+
+
+def _condition_failed(error: Exception) -> bool:
+    # whether a transaction was cancelled by one of its conditions rather
+    # than by a conflicting write or throttling
+    reasons = getattr(error, 'response', {}).get('CancellationReasons', [])
+    return any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons)
 
 
 class ItemTypeDef(TypedDict):
@@ -20,17 +74,23 @@ class ItemTypeDef(TypedDict):
     price: int
 
 
-class OrderListTypeDef(TypedDict):
+class _OrderListTypeDef(TypedDict):
     firstname: str
     items: List[ItemTypeDef]
 
 
+class OrderListTypeDef(_OrderListTypeDef, total=False):
+    # running totals of the items, kept in step by add_item/remove_item
+    counts: dict[str, int]
+    subtotal: int
+
+
 class JioTypeDef(TypedDict):
     chat_id: int
     timestamp: int
     starter_id: int
     status: Literal['Open', 'Closed']
-    type: Literal['Al Amaan']
+    type: str
     closes: Literal[15, 30, 45, 60, 90]
     split: Literal['Split Equally', 'Weighted', 'Free']
     gst: Literal['Included', 'Not Included']
@@ -38,46 +98,279 @@ class JioTypeDef(TypedDict):
     orders: dict[str, OrderListTypeDef]
 
 
-JIO_TYPE: List[str] = JioTypeDef.__annotations__['type'].__args__
+JIO_TYPE: List[str] = list(MENU_FILES)
 JIO_CLOSES: List[int] = JioTypeDef.__annotations__['closes'].__args__
 JIO_SPLIT: List[str] = JioTypeDef.__annotations__['split'].__args__
 JIO_GST: List[str] = JioTypeDef.__annotations__['gst'].__args__
 JIO_DELIVERY = 300
-GST_RATE = decimal.Decimal(0.07)
+JIO_SPLITS: dict[str, Split] = dict(zip(JIO_SPLIT, Split))
+# sort key of the item holding the open jio of a chat, closed jios are
+# archived under the timestamp they were opened at; the order of each user in
+# the open jio is a separate item under the sort key -user_id, which is
+# deleted with the jio so that the query of the open jio only reads its own
+# orders
+ACTIVE_TIMESTAMP = 0
+# dynamodb limit of requests in a batch_write_item call
+BATCH_WRITE_SIZE = 25
+# dynamodb limit of actions in a transact_write_items call
+TRANSACT_WRITE_SIZE = 100
+# open jios older than this are treated as abandoned
+JIO_MAX_AGE = 4 * 60 * 60
+# sort key of the compressed history of a chat's closed jios, below any
+# timestamp a jio is archived under
+HISTORY_TIMESTAMP = 1
+# archived jios and their orders are expired by dynamodb ttl, their summary
+# stays in the history
+ARCHIVE_TTL = 30 * 24 * 60 * 60
+# sort key of the item counting how often each item has been added in a
+# chat under 'item:<name>'; top-level attributes as ADD cannot update nested
+# maps
+POPULARITY_TIMESTAMP = 2
+POPULARITY_PREFIX = 'item:'
+# each user's counts in the chat are a separate item under this plus the user
+# id, above any timestamp a jio is archived under (user ids fit in 52 bits)
+USER_POPULARITY_TIMESTAMP = 1 << 53
+# counters kept in a popularity item; once an add takes it past the slack,
+# the least added are removed so that it stays small to read
+POPULARITY_KEPT = 100
+POPULARITY_SLACK = 20
+# sparse global secondary index on status and closes_at, only the active jio
+# item has closes_at so the index holds just the open jios of every chat
+DUE_INDEX = os.environ.get('DUE_INDEX', 'status-closes_at')
+
+
+class UnitOfWork:
+    # caches the active jio of each chat for the duration of one update, so
+    # that repeated Jio.exists() calls cost a single query
+    def __init__(self):
+        self.jios: dict[int, Optional['Jio']] = {}
+        self.round_trips = 0
+        self.token: Optional[Token[Optional[UnitOfWork]]] = None
+
+    def __enter__(self) -> 'UnitOfWork':
+        self.token = _UNIT_OF_WORK.set(self)
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        if self.token:
+            _UNIT_OF_WORK.reset(self.token)
+
+
+# a context variable, so that updates handled concurrently in threads each
+# have their own
+_UNIT_OF_WORK: ContextVar[Optional[UnitOfWork]] = ContextVar('unit_of_work', default=None)
+
+
+@timed('DynamoDB')
+def _call(operation: Callable[..., Any], **kwargs: Any) -> Any:
+    unit_of_work = _UNIT_OF_WORK.get()
+    if unit_of_work:
+        unit_of_work.round_trips += 1
+    return operation(**kwargs)
+
+
+def _snapshot(chat_id: int, jio: Optional['Jio']):
+    unit_of_work = _UNIT_OF_WORK.get()
+    if unit_of_work:
+        unit_of_work.jios[chat_id] = jio
+
+
+def _key(chat_id: int, timestamp: int) -> dict[str, AttributeValue]:
+    return {
+        'chat_id': {'N': str(chat_id)},
+        'timestamp': {'N': str(timestamp)}
+    }
+
+
+def _order_key(chat_id: int, user_id: str) -> dict[str, AttributeValue]:
+    return _key(chat_id, -int(user_id))
+
+
+def _batch_delete(keys: list[dict[str, AttributeValue]]):
+    # the order items of a jio of more users than fit in the transaction
+    # that removed it; best effort, as those left are skipped by _load() and
+    # expired by ttl
+    try:
+        for start in range(0, len(keys), BATCH_WRITE_SIZE):
+            request_items: Any = {get_table_name(): [{'DeleteRequest': {'Key': key}}
+                                                     for key in keys[start:start + BATCH_WRITE_SIZE]]}
+            while request_items:
+                response = _call(get_client().batch_write_item, RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+    except Exception:
+        logger.exception('failed to delete order items')
+
+
+def get_history(chat_id: int) -> list[HistoryEntry]:
+    # the closed jios of a chat, newest first, with a single read
+    response = _call(get_client().get_item, TableName=get_table_name(), Key=_key(chat_id, HISTORY_TIMESTAMP))
+    return history.decode(response.get('Item', {}).get('history', {}).get('B'))
+
+
+def _popularity_key(chat_id: int, user_id: Optional[int] = None) -> dict[str, AttributeValue]:
+    if user_id is None:
+        return _key(chat_id, POPULARITY_TIMESTAMP)
+    return _key(chat_id, USER_POPULARITY_TIMESTAMP + user_id)
+
+
+def _ranked(item: dict[str, AttributeValue]) -> list[str]:
+    # the items counted in a popularity item, most added first
+    counts = [(-int(value['N']), name[len(POPULARITY_PREFIX):])
+              for name, value in item.items() if name.startswith(POPULARITY_PREFIX)]
+    return [name for _, name in sorted(counts)]
+
+
+def _add_popularity(key: dict[str, AttributeValue], counts: dict[str, int]):
+    # atomic increments, so that concurrent adds in a chat are all counted
+    names: dict[str, str] = {}
+    values: dict[str, Any] = {}
+    additions: list[str] = []
+    for index, (item, count) in enumerate(counts.items()):
+        names['#n%d' % index] = POPULARITY_PREFIX + item
+        values[':n%d' % index] = count
+        additions.append('#n{0} :n{0}'.format(index))
+    response = _call(
+        get_client().update_item,
+        TableName=get_table_name(),
+        Key=key,
+        UpdateExpression='ADD %s' % ', '.join(additions),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=encode_item(values),
+        ReturnValues='ALL_NEW'
+    )
+    item = response.get('Attributes', {})
+    # everything but the key and the most added counters, which includes the
+    # per-user counters tables kept in the chat item before they were split
+    counters = [name for name in item if name not in key]
+    if len(counters) <= POPULARITY_KEPT + POPULARITY_SLACK:
+        return
+    kept = {POPULARITY_PREFIX + name for name in _ranked(item)[:POPULARITY_KEPT]}
+    removed = [name for name in counters if name not in kept]
+    # an add of a removed counter in between is lost with it
+    _call(
+        get_client().update_item,
+        TableName=get_table_name(),
+        Key=key,
+        UpdateExpression='REMOVE %s' % ', '.join('#r%d' % index for index in range(len(removed))),
+        ExpressionAttributeNames={'#r%d' % index: name for index, name in enumerate(removed)}
+    )
+
+
+def record_popularity(chat_id: int, user_id: int, counts: dict[str, int]):
+    _add_popularity(_popularity_key(chat_id), counts)
+    _add_popularity(_popularity_key(chat_id, user_id), counts)
+
+
+def get_favourites(chat_id: int, user_id: int) -> list[str]:
+    # the items the user adds most in the chat, then those the chat adds
+    # most, with a single read of both items; keys left unprocessed under
+    # throttling only shorten the row
+    chat_key = _popularity_key(chat_id)
+    user_key = _popularity_key(chat_id, user_id)
+    response = _call(get_client().batch_get_item, RequestItems={get_table_name(): {'Keys': [chat_key, user_key]}})
+    items = {item['timestamp']['N']: item for item in response['Responses'].get(get_table_name(), [])}
+    favourites: dict[str, None] = {}
+    for key in (user_key, chat_key):
+        favourites.update((name, None) for name in _ranked(items.get(key['timestamp']['N'], {})))
+    return list(favourites)
 
 
 class Jio:
+    __slots__ = ('chat_id', 'timestamp', 'starter_id', 'type', 'closes', 'split', 'gst', 'delivery', 'orders',
+                 'untotalled')
+
     @staticmethod
-    def exists(chat_id: int):
-        time_window = int(time.time()) - (4 * 60 * 60)
-        response = TABLE.query(
-            Select='ALL_ATTRIBUTES',
-            ConsistentRead=True,
-            KeyConditionExpression=Key('chat_id').eq(
-                chat_id) & Key('timestamp').gt(time_window),
-            FilterExpression=Attr('status').eq('Open')
-        )
-        if response['Count']:
-            jio = response['Items'][0]
-            timestamp = jio['timestamp']
-            starter_id = jio['starter_id']
-            type = jio['type']
-            closes = jio['closes']
-            split = jio['split']
-            gst = jio['gst']
-            delivery = jio['delivery']
-            orders = jio['orders']
-            return Jio(chat_id, timestamp, starter_id, type, closes, split, gst, delivery, orders)
+    def _load(chat_id: int) -> Optional['Jio']:
+        # assembles the active jio and its orders with a single query,
+        # regardless of whether it has been abandoned
+        unit_of_work = _UNIT_OF_WORK.get()
+        if unit_of_work and chat_id in unit_of_work.jios:
+            return unit_of_work.jios[chat_id]
+        items: list[dict[str, AttributeValue]] = []
+        kwargs: dict[str, Any] = {
+            'TableName': get_table_name(),
+            'ConsistentRead': True,
+            'KeyConditionExpression': 'chat_id = :chat_id AND #ts <= :active',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'},
+            'ExpressionAttributeValues': encode_item({':chat_id': chat_id, ':active': ACTIVE_TIMESTAMP})
+        }
+        while True:
+            response = _call(get_client().query, **kwargs)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        jio: Optional[Jio] = None
+        # the active jio sorts after the orders
+        if items and int(items[-1]['timestamp']['N']) == ACTIVE_TIMESTAMP:
+            header = items.pop()
+            opened = header['opened']['N']
+            # skip orders left behind by an earlier jio
+            orders: dict[str, OrderListTypeDef] = {}
+            untotalled: set[str] = set()
+            for item in items:
+                if item['opened']['N'] != opened:
+                    continue
+                user_id = str(-int(item['timestamp']['N']))
+                order = decode_order(item)
+                if 'counts' not in order:  # written before orders kept running totals
+                    order['counts'], order['subtotal'] = aggregate(order['items'])
+                    untotalled.add(user_id)
+                orders[user_id] = order
+            jio = Jio(
+                chat_id,
+                int(opened),
+                int(header['starter_id']['N']),
+                header['type']['S'],
+                int(header['closes']['N']),
+                header['split']['S'],
+                header['gst']['S'],
+                int(header['delivery']['N']),
+                orders,
+                untotalled
+            )
+        _snapshot(chat_id, jio)
+        return jio
+
+    @staticmethod
+    def exists(chat_id: int) -> Optional['Jio']:
+        jio = Jio._load(chat_id)
+        if jio and jio.timestamp > int(time.time()) - JIO_MAX_AGE:
+            return jio
         return None
 
+    @staticmethod
+    def due(now: int) -> list[Tuple[int, int]]:
+        # chat ids and opening timestamps of the open jios whose closing time
+        # has passed, from the index rather than by scanning the table; the
+        # index is eventually consistent, so callers check the jio again
+        due: list[Tuple[int, int]] = []
+        kwargs: dict[str, Any] = {
+            'TableName': get_table_name(),
+            'IndexName': DUE_INDEX,
+            'KeyConditionExpression': '#st = :open AND closes_at <= :now',
+            'ExpressionAttributeNames': {'#st': 'status'},
+            'ExpressionAttributeValues': encode_item({':open': 'Open', ':now': now})
+        }
+        while True:
+            response = _call(get_client().query, **kwargs)
+            due.extend((int(item['chat_id']['N']), int(item['opened']['N'])) for item in response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return due
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
     @staticmethod
     def create(chat_id: int, starter_id: int, type: str, closes: int, split: str, gst: str, delivery: int) -> bool:
-        if Jio.exists(chat_id):
+        abandoned = Jio._load(chat_id)
+        timestamp = int(time.time())
+        if abandoned and abandoned.timestamp > timestamp - JIO_MAX_AGE:
             return False
-        else:
-            TABLE.put_item(Item={
+        transact_items: list[dict[str, Any]] = [{'Put': {
+            'TableName': get_table_name(),
+            'Item': encode_item({
                 'chat_id': chat_id,
-                'timestamp': int(time.time()),
+                'timestamp': ACTIVE_TIMESTAMP,
+                'opened': timestamp,
                 'starter_id': starter_id,
                 'status': 'Open',
                 'type': type,
@@ -85,11 +378,28 @@ class Jio:
                 'split': split,
                 'gst': gst,
                 'delivery': delivery,
-                'orders': {}
-            })
-            return True
+                'closes_at': timestamp + closes * 60
+            }),
+            # only replace an abandoned jio
+            'ConditionExpression': 'attribute_not_exists(chat_id) OR opened <= :abandoned',
+            'ExpressionAttributeValues': encode_item({':abandoned': timestamp - JIO_MAX_AGE})
+        }}]
+        left: list[dict[str, AttributeValue]] = []
+        if abandoned:
+            # keep the abandoned jio as history, as it is still open
+            transact_items.append(abandoned._archive('Open'))
+            left = abandoned._delete_orders(transact_items)
+        try:
+            _call(get_client().transact_write_items, TransactItems=transact_items)
+        except transaction_canceled() as e:
+            if _condition_failed(e):
+                return False
+            raise
+        _batch_delete(left)
+        _snapshot(chat_id, Jio(chat_id, timestamp, starter_id, type, closes, split, gst, delivery, {}))
+        return True
 
-    def __init__(self, chat_id: int, timestamp: int, starter_id: int, type: str, closes: int, split: str, gst: str, delivery: int, orders: dict[str, OrderListTypeDef]):
+    def __init__(self, chat_id: int, timestamp: int, starter_id: int, type: str, closes: int, split: str, gst: str, delivery: int, orders: dict[str, OrderListTypeDef], untotalled: Optional[set[str]] = None):
         self.chat_id = chat_id
         self.timestamp = timestamp
         self.starter_id = starter_id
@@ -99,6 +409,9 @@ class Jio:
         self.gst = gst
         self.delivery = delivery
         self.orders = orders
+        # users whose order item has no running totals yet, which cannot be
+        # updated in place and is written whole instead
+        self.untotalled = untotalled or set()
 
     def __repr__(self):
         return '<%d, %d, %d, %s, %d, %s, %s, %d>' % (
@@ -112,165 +425,222 @@ class Jio:
             self.delivery
         )
 
-    def _close(self) -> bool:
-        response = TABLE.update_item(
-            Key={
-                'chat_id': self.chat_id,
-                'timestamp': self.timestamp
-            },
-            UpdateExpression='SET #s = :status',
-            ExpressionAttributeNames={'#s': 'status'},
-            ExpressionAttributeValues={':status': 'Closed'}
-        )
-        return response['ResponseMetadata']['HTTPStatusCode'] == 200
-
-    def close(self) -> Tuple[str, dict[str, str]]:
-        order_summary: List[str] = []
-        user_messages: dict[str, str] = {}
-        # combine all orders into single list
-        all_items = list(itertools.chain.from_iterable(
-            [order['items'] for order in self.orders.values()]))
-        if len(all_items) == 0:
-            order_summary.append('Jio is closed! There were no items ordered.')
-        else:
-            order_summary.append(
-                'Jio is closed! Here are the items ordered:\n')
-            # count quantity ordered for each item
-            all_items = [(item['item'], item['price']) for item in all_items]
-            for item, count in Counter(all_items).items():
-                order_summary.append('%s x %d' % (item[0], count))
-            order_summary.append(
-                '\nPlease pay per person total:\n')
-            # calculate order totals for each user, exclude users with no items
-            user_total: dict[str, int] = {}
-            user_gst: dict[str, int] = {}
-            user_delivery: dict[str, int] = {}
-            for user_id, user_order in self.orders.items():
-                if len(user_order['items']) == 0:
-                    continue
-                user_total[user_id] = sum([item['price']
-                                          for item in user_order['items']])
-                # calculate gst if included
-                if self.gst == JIO_GST[0]:  # Included
-                    user_gst[user_id] = math.ceil(
-                        user_total[user_id] * GST_RATE)
-                else:
-                    user_gst[user_id] = 0
-            grand_total = sum(user_total.values())
-            # calculate delivery fee for each user
-            for user_id, user_order in self.orders.items():
-                if len(user_order['items']) == 0:
-                    continue
-                if self.split == JIO_SPLIT[0]:  # Split Equally
-                    user_delivery[user_id] = math.ceil(
-                        self.delivery / len(user_total))
-                elif self.split == JIO_SPLIT[1]:  # Weighted
-                    user_delivery[user_id] = math.ceil(
-                        self.delivery * (user_total[user_id] / grand_total))
-                elif self.split == JIO_SPLIT[2]: # Free
-                    user_delivery[user_id] = 0
-                user_grand_total = sum([
-                    user_total[user_id],
-                    user_delivery[user_id],
-                    user_gst[user_id]
-                ])
-                user_order_summary = '%s - $%.2f' % (user_order['firstname'], user_grand_total/100)
-                user_inclusion_string = ''
-                user_inclusions: list[str] = []
-                if self.split != JIO_SPLIT[2]: # not=Free
-                    user_inclusions.append('$%.2f delivery' % (user_delivery[user_id]/100))
-                if self.gst == JIO_GST[0]:
-                    user_inclusions.append('$%.2f GST' % (user_gst[user_id]/100))
-                if user_inclusions:
-                    user_inclusion_string = ' (incl. %s)' % (' & '.join(user_inclusions))
-                order_summary.append('%s%s' % (user_order_summary, user_inclusion_string))
-                user_messages[user_id] = 'Your food order costs *$%.2f* in total%s' % (
-                    user_grand_total/100,
-                    user_inclusion_string
-                )
-            # grand total is user_total sum, plus GST if included and delivery fee
-            grand_total_gst = grand_total * GST_RATE
-            if self.gst == JIO_GST[0]:  # Included
-                grand_total += grand_total_gst
-            grand_total += self.delivery
-            grand_total_summary = '\n*Grand Total* - $%.2f' % (grand_total/100)
-            if self.gst == JIO_GST[0]: # Included
-                grand_total_summary += ' (GST $%.2f %s)' % (grand_total_gst/100, JIO_GST[0].lower())
-            else:
-                grand_total_summary += ' (GST %s)' % (JIO_GST[1].lower())
-            order_summary.append(grand_total_summary)
-        # close the jio
-        if self._close():
-            return '\n'.join(order_summary), user_messages
-        else:
-            raise Exception('dynamodb.update_item() returned status code is not 200')
+    def _archive(self, status: str) -> dict[str, Any]:
+        # the write that stores the jio under the timestamp it was opened at,
+        # made in the same transaction that removes the active jio; the
+        # archive keeps the number of users rather than their orders, so it
+        # stays small however many users ordered
+        return {'Put': {'TableName': get_table_name(), 'Item': encode_item({
+            'chat_id': self.chat_id,
+            'timestamp': self.timestamp,
+            'starter_id': self.starter_id,
+            'status': status,
+            'type': self.type,
+            'closes': self.closes,
+            'split': self.split,
+            'gst': self.gst,
+            'delivery': self.delivery,
+            'users': len(self.orders),
+            'expires': int(time.time()) + ARCHIVE_TTL
+        })}}
+
+    def _delete_orders(self, transact_items: list[dict[str, Any]]) -> list[dict[str, AttributeValue]]:
+        # adds the deletes of the order items to the transaction that removes
+        # the active jio, so that they go if and only if the jio does and an
+        # order placed in the chat's next jio is not deleted with them;
+        # returns the keys of those that do not fit, deleted right after it.
+        # Orders added while the jio is removed are left behind, skipped by
+        # _load() as they were opened earlier and expired by ttl.
+        keys = [_order_key(self.chat_id, user_id) for user_id in self.orders]
+        room = TRANSACT_WRITE_SIZE - len(transact_items)
+        transact_items.extend({'Delete': {'TableName': get_table_name(), 'Key': key}} for key in keys[:room])
+        return keys[room:]
+
+    def _record_history(self, settlement: Settlement):
+        # only one jio of a chat is closed at a time, as close() is
+        # conditional, so the read and write of the history do not race
+        key = _key(self.chat_id, HISTORY_TIMESTAMP)
+        response = _call(get_client().get_item, TableName=get_table_name(), Key=key, ConsistentRead=True)
+        data = response.get('Item', {}).get('history', {}).get('B')
+        entry = history.entry(self.timestamp, self.type, settlement, self.orders)
+        _call(get_client().put_item, TableName=get_table_name(), Item={
+            **key,
+            'history': {'B': history.append(data, entry)}
+        })
+
+    def settle(self) -> Settlement:
+        return settle(self.orders, JIO_SPLITS[self.split], self.gst == JIO_GST[0], self.delivery)
+
+    def close(self, settlement: Optional[Settlement] = None, writes: Sequence[dict[str, Any]] = ()) -> bool:
+        # removes the active jio and archives it in one transaction, so that
+        # a failed write leaves the jio open rather than lost; the writes are
+        # made in the same transaction, e.g. recording the summaries of the
+        # settlement in the outbox, so that they are made if and only if the
+        # jio is closed. False if it was closed or replaced already, e.g. by
+        # the sweeper
+        if settlement is None:
+            settlement = self.settle()
+        transact_items: list[dict[str, Any]] = [
+            {'Delete': {
+                'TableName': get_table_name(),
+                'Key': _key(self.chat_id, ACTIVE_TIMESTAMP),
+                'ConditionExpression': 'opened = :opened',
+                'ExpressionAttributeValues': encode_item({':opened': self.timestamp})
+            }},
+            self._archive('Closed'),
+            *writes
+        ]
+        left = self._delete_orders(transact_items)
+        try:
+            _call(get_client().transact_write_items, TransactItems=transact_items)
+        except transaction_canceled() as e:
+            if _condition_failed(e):
+                return False
+            raise
+        _batch_delete(left)
+        _snapshot(self.chat_id, None)
+        try:
+            self._record_history(settlement)
+        except Exception:
+            # the jio is closed regardless and its summaries still sent
+            logger.exception('failed to record history of chat %d', self.chat_id)
+        return True
 
     def add_item(self, user_id: int, firstname: str, item: str, price: int) -> bool:
-        order_item = ItemTypeDef(item=item, price=price)
-        if str(user_id) in self.orders:
-            response = TABLE.update_item(
-                Key={
-                    'chat_id': self.chat_id,
-                    'timestamp': self.timestamp
-                },
-                UpdateExpression='SET #ord.#usr.#itm = list_append(#ord.#usr.#itm, :order)',
-                ExpressionAttributeNames={
-                    '#ord': 'orders',
-                    '#usr': str(user_id),
-                    '#itm': 'items'
-                },
-                ExpressionAttributeValues={':order': [order_item]}
+        return self.add_items(user_id, firstname, [ItemTypeDef(item=item, price=price)])
+
+    def add_items(self, user_id: int, firstname: str, order_items: List[ItemTypeDef]) -> bool:
+        # appends all items with a single write, e.g. 3 of one item and 2 of
+        # another picked with the quantity buttons or /additem 3x ..., 2x ...
+        if not order_items:
+            return False
+        added, price = aggregate(order_items)
+        order = self.orders.get(str(user_id))
+        if order and order['counts'] and str(user_id) not in self.untotalled:
+            names: dict[str, str] = {'#itm': 'items', '#cnt': 'counts', '#sub': 'subtotal'}
+            values: dict[str, Any] = {':order': order_items, ':zero': 0, ':price': price}
+            expressions: list[str] = []
+            for index, (item, count) in enumerate(added.items()):
+                names['#n%d' % index] = item
+                values[':c%d' % index] = count
+                expressions.append('#cnt.#n{0} = if_not_exists(#cnt.#n{0}, :zero) + :c{0}'.format(index))
+            response = _call(
+                get_client().update_item,
+                TableName=get_table_name(),
+                Key=_order_key(self.chat_id, str(user_id)),
+                UpdateExpression='SET #itm = list_append(#itm, :order), %s ADD #sub :price' % ', '.join(expressions),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=encode_item(values)
             )
         else:
-            response = TABLE.update_item(
-                Key={
-                    'chat_id': self.chat_id,
-                    'timestamp': self.timestamp
-                },
-                UpdateExpression='SET #ord.#usr = :order',
-                ExpressionAttributeNames={
-                    '#ord': 'orders',
-                    '#usr': str(user_id)
-                },
-                ExpressionAttributeValues={
-                    ':order': {
-                        'firstname': firstname,
-                        'items': [order_item]
-                    }
-                }
-            )
-        return response['ResponseMetadata']['HTTPStatusCode'] == 200
+            # replaces any order left behind by an earlier jio, an order whose
+            # items were all removed or one without running totals
+            items = (order['items'] if order else []) + order_items
+            response = self._put_order(str(user_id), firstname, items)
+        if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+            self.untotalled.discard(str(user_id))
+            # keep the snapshot in step with the table
+            if order:
+                order['items'].extend(order_items)
+                for item, count in added.items():
+                    order['counts'][item] = order['counts'].get(item, 0) + count
+                order['subtotal'] += price
+            else:
+                self.orders[str(user_id)] = OrderListTypeDef(
+                    firstname=firstname, items=list(order_items), counts=added, subtotal=price)
+            try:
+                record_popularity(self.chat_id, user_id, added)
+            except Exception:
+                # the items are added regardless
+                logger.exception('failed to record popularity in chat %d', self.chat_id)
+            return True
+        return False
+
+    def _put_order(self, user_id: str, firstname: str, items: List[ItemTypeDef], **kwargs: Any) -> Any:
+        counts, subtotal = aggregate(items)
+        return _call(
+            get_client().put_item,
+            TableName=get_table_name(),
+            Item={
+                **_order_key(self.chat_id, user_id),
+                **encode_item({
+                    'opened': self.timestamp,
+                    'firstname': firstname,
+                    'items': items,
+                    'counts': counts,
+                    'subtotal': subtotal,
+                    # kept after the jio is closed, with the archive
+                    'expires': self.timestamp + JIO_MAX_AGE + ARCHIVE_TTL
+                })
+            },
+            **kwargs
+        )
 
     def remove_item(self, user_id: int, index: int) -> bool:
         if str(user_id) in self.orders:
             user_items: OrderListTypeDef = self.orders[str(user_id)]
             if index < len(user_items['items']):
-                response = TABLE.update_item(
-                    Key={
-                        'chat_id': self.chat_id,
-                        'timestamp': self.timestamp
-                    },
-                    UpdateExpression='REMOVE #ord.#usr.#itm[%d]' % index,
-                    ExpressionAttributeNames={
-                        '#ord': 'orders',
-                        '#usr': str(user_id),
-                        '#itm': 'items'
-                    }
-                )
-                return response['ResponseMetadata']['HTTPStatusCode'] == 200
+                removed = user_items['items'][index]
+                count = user_items['counts'][removed['item']] - 1
+                try:
+                    if str(user_id) in self.untotalled:
+                        response = self._put_order(
+                            str(user_id),
+                            user_items['firstname'],
+                            user_items['items'][:index] + user_items['items'][index + 1:],
+                            # the item may have been removed by an earlier update
+                            ConditionExpression='#itm[%d].#item = :item' % index,
+                            ExpressionAttributeNames={'#itm': 'items', '#item': 'item'},
+                            ExpressionAttributeValues=encode_item({':item': removed['item']})
+                        )
+                    else:
+                        # drop the count of an item that is no longer ordered
+                        if count:
+                            update_expression = 'SET #cnt.#name = #cnt.#name - :one REMOVE #itm[%d] ADD #sub :price' % index
+                        else:
+                            update_expression = 'REMOVE #itm[%d], #cnt.#name ADD #sub :price' % index
+                        response = _call(
+                            get_client().update_item,
+                            TableName=get_table_name(),
+                            Key=_order_key(self.chat_id, str(user_id)),
+                            UpdateExpression=update_expression,
+                            # the item may have been removed by an earlier update
+                            ConditionExpression='#itm[%d].#item = :item' % index,
+                            ExpressionAttributeNames={
+                                '#itm': 'items',
+                                '#item': 'item',
+                                '#cnt': 'counts',
+                                '#name': removed['item'],
+                                '#sub': 'subtotal'
+                            },
+                            ExpressionAttributeValues=encode_item({
+                                ':item': removed['item'],
+                                ':price': -removed['price'],
+                                **({':one': 1} if count else {})
+                            })
+                        )
+                except conditional_check_failed():
+                    # removed by an earlier update, e.g. a stale keyboard or
+                    # a redelivered update
+                    return False
+                if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+                    self.untotalled.discard(str(user_id))
+                    user_items['items'].pop(index)
+                    if count:
+                        user_items['counts'][removed['item']] = count
+                    else:
+                        del user_items['counts'][removed['item']]
+                    user_items['subtotal'] -= removed['price']
+                    return True
         return False
 
     def get_order_summary(self) -> str:
         order_strings: List[str] = []
         for user_order in self.orders.values():
             firstname = user_order['firstname']
-            if len(user_order['items']) == 0:
-                continue
-            items = [(item['item'], item['price'])
-                     for item in user_order['items']]
-            for item, count in Counter(items).items():
+            for item, count in user_order['counts'].items():
                 order_strings.append('%s - %s x %d' %
-                                     (firstname, item[0], count))
+                                     (firstname, item, count))
         if order_strings:
             return '\n'.join(order_strings)
         else:
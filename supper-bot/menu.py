@@ -1,27 +1,205 @@
+import functools
+import heapq
 import json
+import os
+import pickle
+import re
 
-from collections import OrderedDict
-from typing import Any, Union
+from collections import Counter, OrderedDict, deque
+from itertools import chain
+from typing import Any, Optional, Tuple
 
-MENU = json.load(open('menus/al_amaan.json', 'r'), object_pairs_hook=OrderedDict)
+MENU_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'menus')
+# jio type -> menu file in MENU_DIR, in the order offered by /openjio
+MENU_FILES: dict[str, str] = {
+    'Al Amaan': 'al_amaan.json',
+}
+MENU_CACHE_SIZE = int(os.environ.get('MENU_CACHE_SIZE', '8'))
+# bump when CompiledMenu changes so that stale pickled artifacts are ignored
+MENU_ARTIFACT_VERSION = 3
+# most items offered for a search
+SEARCH_LIMIT = 8
+# share of the trigrams of a query an item has to contain to be offered
+SEARCH_MIN_SCORE = 0.5
 
+# price stored for category nodes, which have no price of their own
+CATEGORY = -1
 
-def get_menu_choices(selections: list[int]):
-    # start from the menu root
-    menu_pointer: Union[dict[str, Any], int] = MENU
-    last_key = ''
-    while len(selections):
-        index = selections.pop(0)
-        if isinstance(menu_pointer, dict):
-            last_key = list(menu_pointer.keys())[index]
-            menu_pointer: Union[dict[str, Any], int] = menu_pointer[last_key]
-        else:  # reached a leaf item of type int
-            return None, (last_key, menu_pointer)
+
+class CompiledMenu:
+    def __init__(self, menu: dict[str, Any]):
+        # node 0 is the menu root, every other node is a category or an item;
+        # node indices double as integer item ids
+        self.names: list[str] = ['']
+        self.prices: list[int] = [CATEGORY]
+        self.labels: list[str] = ['']
+        self.parents: list[int] = [0]
+        self.child_start: list[int] = [0]
+        self.child_count: list[int] = [0]
+        # breadth-first layout, so the children of a node occupy a contiguous
+        # range of indices starting at child_start[node]
+        queue: deque[Tuple[int, dict[str, Any]]] = deque([(0, menu)])
+        while queue:
+            node, children = queue.popleft()
+            self.child_start[node] = len(self.names)
+            self.child_count[node] = len(children)
+            for name, value in children.items():
+                child = len(self.names)
+                self.names.append(name)
+                self.parents.append(node)
+                self.child_start.append(0)
+                self.child_count.append(0)
+                if isinstance(value, dict):
+                    self.prices.append(CATEGORY)
+                    self.labels.append(name)
+                    queue.append((child, value))
+                else:
+                    self.prices.append(value)
+                    self.labels.append('%s - ($%.2f)' % (name, value/100))
+        # pre-rendered keyboard choices for every node
+        self.choices: list[list[str]] = [
+            self.labels[start:start + count]
+            for start, count in zip(self.child_start, self.child_count)
+        ]
+        # trigram -> items whose name contains it, in node order
+        self.trigrams: dict[str, list[int]] = {}
+        # lowercased item name -> first item with that name
+        self.items: dict[str, int] = {}
+        for node, name in enumerate(self.names):
+            if self.is_item(node):
+                for trigram in sorted(_trigrams(name)):
+                    self.trigrams.setdefault(trigram, []).append(node)
+                self.items.setdefault(name.lower(), node)
+
+    def is_item(self, node: int) -> bool:
+        return self.prices[node] != CATEGORY
+
+    def navigate(self, selections: list[int]) -> int:
+        node = 0
+        for index in selections:
+            if self.prices[node] != CATEGORY:  # reached a leaf item
+                break
+            if not 0 <= index < self.child_count[node]:
+                raise IndexError('menu selection out of range: %d' % index)
+            node = self.child_start[node] + index
+        return node
+
+    def _scores(self, query: str) -> Tuple['Counter[int]', float]:
+        # number of trigrams of the query each item contains, and the score
+        # an item needs to be offered
+        trigrams = _trigrams(query)
+        scores = Counter(chain.from_iterable(self.trigrams.get(trigram, ()) for trigram in trigrams))
+        return scores, len(trigrams) * SEARCH_MIN_SCORE
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> list[int]:
+        # items ranked by the number of trigrams of the query they contain,
+        # ties in menu order
+        scores, threshold = self._scores(query)
+        return heapq.nsmallest(limit, (node for node, score in scores.items() if score >= threshold),
+                               key=lambda node: (-scores[node], node))
+
+    def find(self, name: str) -> Optional[int]:
+        # the item of a typed order: the one named exactly, ignoring case,
+        # else the best search result unless another one scores the same
+        node = self.items.get(name.strip().lower())
+        if node is not None:
+            return node
+        scores, threshold = self._scores(name)
+        best = heapq.nlargest(2, scores.items(), key=lambda entry: entry[1])
+        if not best or best[0][1] < threshold or (len(best) > 1 and best[1][1] == best[0][1]):
+            return None
+        return best[0][0]
+
+    def path(self, node: int) -> list[int]:
+        # selections that lead from the menu root to the node
+        selections: list[int] = []
+        while node:
+            parent = self.parents[node]
+            selections.append(node - self.child_start[parent])
+            node = parent
+        selections.reverse()
+        return selections
+
+
+def _trigrams(text: str) -> set[str]:
+    # of each word, padded so that the start and end of words weigh more
+    trigrams: set[str] = set()
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        padded = ' %s ' % word
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def _artifact_path(filename: str) -> str:
+    return os.path.join(MENU_DIR, os.path.splitext(filename)[0] + '.pickle')
+
+
+def _load_menu(filename: str) -> CompiledMenu:
+    path = os.path.join(MENU_DIR, filename)
+    artifact = _artifact_path(filename)
+    # use the pre-compiled artifact unless it is older than the menu file
+    if os.path.exists(artifact) and os.path.getmtime(artifact) >= os.path.getmtime(path):
+        with open(artifact, 'rb') as f:
+            version, menu = pickle.load(f)
+        if version == MENU_ARTIFACT_VERSION:
+            return menu
+    with open(path, 'r') as f:
+        return CompiledMenu(json.load(f, object_pairs_hook=OrderedDict))
+
+
+@functools.lru_cache(maxsize=MENU_CACHE_SIZE)
+def get_menu(jio_type: str) -> CompiledMenu:
+    return _load_menu(MENU_FILES[jio_type])
+
+
+def compile_menus():
+    for filename in MENU_FILES.values():
+        with open(os.path.join(MENU_DIR, filename), 'r') as f:
+            menu = CompiledMenu(json.load(f, object_pairs_hook=OrderedDict))
+        with open(_artifact_path(filename), 'wb') as f:
+            pickle.dump((MENU_ARTIFACT_VERSION, menu), f, pickle.HIGHEST_PROTOCOL)
+
+
+def get_menu_choices(jio_type: str, selections: list[int]) -> Tuple[Optional[list[str]], Optional[Tuple[str, int]]]:
+    menu = get_menu(jio_type)
+    node = menu.navigate(selections)
+    if menu.is_item(node):
+        return None, (menu.names[node], menu.prices[node])
     # return list of menu choices
-    if isinstance(menu_pointer, dict):
-        item_names = list(menu_pointer.keys())
-        item_names = ['%s - ($%.2f)' % (item_name, menu_pointer[item_name]/100) if isinstance(
-            menu_pointer[item_name], int) else item_name for item_name in item_names]
-        return item_names, None
-    else:
-        return None, (last_key, menu_pointer)
+    return menu.choices[node], None
+
+
+def split_quantity(jio_type: str, selections: list[int]) -> Tuple[list[int], int]:
+    # the quantity buttons shown after an item is added repeat the path of
+    # the item followed by the quantity to add; returns the path of the item
+    # and the quantity, 1 for the item itself
+    menu = get_menu(jio_type)
+    depth = len(menu.path(menu.navigate(selections)))
+    return selections[:depth], selections[depth] if len(selections) > depth else 1
+
+
+def find_item(jio_type: str, name: str) -> Optional[Tuple[str, int]]:
+    menu = get_menu(jio_type)
+    node = menu.find(name)
+    if node is None:
+        return None
+    return menu.names[node], menu.prices[node]
+
+
+def get_item_nodes(jio_type: str, names: list[str]) -> Tuple[int, ...]:
+    # the items of the menu with these exact names, others are skipped
+    menu = get_menu(jio_type)
+    nodes = (menu.items.get(name.lower()) for name in names)
+    return tuple(node for node in nodes if node is not None)
+
+
+def search_menu(jio_type: str, query: str) -> list[Tuple[str, list[int]]]:
+    # labels of the best matching items with the selections that lead to them
+    menu = get_menu(jio_type)
+    return [(menu.labels[node], menu.path(node)) for node in menu.search(query)]
+
+
+if __name__ == '__main__':
+    # pickle CompiledMenu under its importable name rather than __main__
+    import menu
+    menu.compile_menus()
@@ -0,0 +1,102 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextvars import ContextVar, Token
+from typing import Any, Callable, Optional, TypeVar
+
+# set to 1 to print one cloudwatch embedded metric format record per update,
+# when unset timed() leaves functions unwrapped
+METRICS = os.environ.get('METRICS', '0') == '1'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'SupperBot')
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+class UpdateMetrics:
+    # collects the call counts and durations of one update and prints them
+    # as a single record on exit
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.counts: dict[str, int] = {}
+        self.durations: dict[str, float] = {}
+        self.properties: dict[str, Any] = {'Command': 'none'}
+        # the dispatcher records bot api calls from its worker threads
+        self.lock = threading.Lock()
+        self.token: Optional[Token[Optional[UpdateMetrics]]] = None
+
+    def __enter__(self) -> 'UpdateMetrics':
+        if METRICS:
+            self.token = _METRICS.set(self)
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        global _COLD_START
+        if self.token:
+            _METRICS.reset(self.token)
+            self.properties['ColdStart'] = _COLD_START
+            _COLD_START = False
+            sys.stdout.write(json.dumps(self.record()) + '\n')
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def record(self) -> dict[str, Any]:
+        # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+        values: dict[str, Any] = {'Duration': round((time.perf_counter() - self.start) * 1000, 3)}
+        definitions = [{'Name': 'Duration', 'Unit': 'Milliseconds'}]
+        for name in sorted(self.counts):
+            values[name + 'Calls'] = self.counts[name]
+            values[name + 'Time'] = round(self.durations[name] * 1000, 3)
+            definitions.append({'Name': name + 'Calls', 'Unit': 'Count'})
+            definitions.append({'Name': name + 'Time', 'Unit': 'Milliseconds'})
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Command']],
+                    'Metrics': definitions
+                }]
+            },
+            **self.properties,
+            **values
+        }
+
+
+_METRICS: ContextVar[Optional[UpdateMetrics]] = ContextVar('metrics', default=None)
+# the first update handled by this process
+_COLD_START = True
+
+
+def timed(name: str) -> Callable[[F], F]:
+    # counts the calls of the decorated function and their total duration
+    # under name, e.g. DynamoDBCalls and DynamoDBTime; calls made while
+    # another timed function runs count towards both
+    def decorator(function: F) -> F:
+        if not METRICS:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            metrics = _METRICS.get()
+            if metrics is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.add(name, time.perf_counter() - start)
+        return wrapper  # type: ignore
+    return decorator
+
+
+def set_property(name: str, value: Any):
+    # e.g. the command or menu depth of the update
+    metrics = _METRICS.get()
+    if metrics:
+        metrics.properties[name] = value
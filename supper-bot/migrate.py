@@ -0,0 +1,83 @@
+import argparse
+from typing import Any
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from jio import ACTIVE_TIMESTAMP, get_table
+from settlement import aggregate
+
+
+def find_open_jios() -> dict[int, dict[str, Any]]:
+    # open jios that still hold their orders, either written before the
+    # active jio item (keyed by the timestamp they were opened at, keep the
+    # newest one of each chat) or active jios written before orders were
+    # split into separate items
+    open_jios: dict[int, dict[str, Any]] = {}
+    kwargs: dict[str, Any] = {
+        'FilterExpression': Attr('status').eq('Open') & Attr('orders').exists()
+    }
+    while True:
+        response = get_table().scan(**kwargs)
+        for item in response['Items']:
+            chat_id = int(item['chat_id'])
+            if item['timestamp'] == ACTIVE_TIMESTAMP:
+                open_jios[chat_id] = item
+            elif chat_id not in open_jios or (open_jios[chat_id]['timestamp'] != ACTIVE_TIMESTAMP and
+                                              item['timestamp'] > open_jios[chat_id]['timestamp']):
+                open_jios[chat_id] = item
+        if 'LastEvaluatedKey' not in response:
+            return open_jios
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def migrate_jio(item: dict[str, Any]):
+    chat_id = item['chat_id']
+    opened = item.get('opened', item['timestamp'])
+    orders = item.pop('orders')
+    header = dict(item, timestamp=ACTIVE_TIMESTAMP, opened=opened)
+    if item['timestamp'] == ACTIVE_TIMESTAMP:
+        get_table().put_item(Item=header, ConditionExpression=Attr('opened').eq(opened))
+    else:
+        get_table().put_item(Item=header, ConditionExpression=Attr('chat_id').not_exists())
+    with get_table().batch_writer() as batch:
+        for user_id, order in orders.items():
+            counts, subtotal = aggregate(order['items'])
+            batch.put_item(Item={
+                'chat_id': chat_id,
+                'timestamp': -int(user_id),
+                'opened': opened,
+                'firstname': order['firstname'],
+                'items': order['items'],
+                'counts': counts,
+                'subtotal': subtotal
+            })
+    if item['timestamp'] != ACTIVE_TIMESTAMP:
+        # the jio is archived under the same key again when it is closed
+        get_table().delete_item(Key={
+            'chat_id': chat_id,
+            'timestamp': item['timestamp']
+        })
+
+
+def migrate(dry_run: bool):
+    for chat_id, item in find_open_jios().items():
+        print('chat %d: jio opened at %d' % (chat_id, item.get('opened', item['timestamp'])))
+        if dry_run:
+            continue
+        try:
+            migrate_jio(item)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                print('chat %d: active jio changed, skipped' % chat_id)
+                continue
+            raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Move open jios into the active jio item of their chat, with one item per order.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the jios that would be moved')
+    args = parser.parse_args()
+    migrate(args.dry_run)
@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+import time
+import zlib
+from contextvars import ContextVar, Token
+from typing import TYPE_CHECKING, Any, Callable, Optional, Protocol, Tuple, TypedDict
+
+import metrics
+from codec import encode_item
+from dispatch import DispatchResult, get_dispatcher
+from jio import BATCH_WRITE_SIZE, get_client, get_table_name
+from metrics import timed
+from telegram import send_message
+
+if TYPE_CHECKING:
+    import sqlite3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# 'dynamodb' in lambda, 'sqlite' for local runs and tests
+OUTBOX_BACKEND = os.environ.get('OUTBOX_BACKEND', 'dynamodb')
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', 'outbox.sqlite3')
+# pending messages are kept in the table under this chat id, next to the
+# dedup ledger but under negative sort keys
+OUTBOX_CHAT_ID = 0
+# entries sent by one drain of the outbox at a time
+OUTBOX_BATCH_SIZE = 20
+# messages that could not be delivered within a day are dropped by ttl
+OUTBOX_TTL = 24 * 60 * 60
+# outbox entries of an update are numbered from update_id << OUTBOX_INDEX_BITS
+OUTBOX_INDEX_BITS = 16
+
+
+class OutboxEntry(TypedDict):
+    # the messages recorded together, e.g. all those of closing a jio in one
+    # item, so that they fit in the transaction that closes it; the same id
+    # for the same entry of the same update, so recording a redelivered
+    # update again does not send its messages twice
+    id: int
+    # (chat id, text)
+    messages: list[Tuple[int, str]]
+
+
+def _encode_messages(messages: list[Tuple[int, str]]) -> bytes:
+    # deflated like the history, the summaries of a jio repeat its item names
+    return zlib.compress(json.dumps(messages, separators=(',', ':')).encode(), 9)
+
+
+def _decode_messages(data: bytes) -> list[Tuple[int, str]]:
+    return [(chat_id, text) for chat_id, text in json.loads(zlib.decompress(data))]
+
+
+class Outbox(Protocol):
+    def record(self, entries: list[OutboxEntry]):
+        ...
+
+    def pending(self, limit: int) -> list[OutboxEntry]:
+        ...
+
+    def complete(self, ids: list[int]):
+        ...
+
+
+class DynamoDBOutbox:
+    @staticmethod
+    def _item(entry: OutboxEntry) -> dict[str, Any]:
+        return encode_item({
+            'chat_id': OUTBOX_CHAT_ID,
+            'timestamp': -entry['id'],
+            'messages': _encode_messages(entry['messages']),
+            'expires': int(time.time()) + OUTBOX_TTL
+        })
+
+    @staticmethod
+    def _entry(item: dict[str, Any]) -> OutboxEntry:
+        if 'messages' not in item:
+            # recorded with one message per item before they were grouped
+            return OutboxEntry(id=-int(item['timestamp']['N']), messages=[(int(item['target']['N']), item['text']['S'])])
+        return OutboxEntry(id=-int(item['timestamp']['N']), messages=_decode_messages(item['messages']['B']))
+
+    def transact_put(self, entry: OutboxEntry) -> dict[str, Any]:
+        # records the entry as part of a transact_write_items call
+        return {'Put': {'TableName': get_table_name(), 'Item': self._item(entry)}}
+
+    @timed('Outbox')
+    def record(self, entries: list[OutboxEntry]):
+        # also replaces entries, with the messages of them still to send
+        for start in range(0, len(entries), BATCH_WRITE_SIZE):
+            request_items: Any = {get_table_name(): [{'PutRequest': {'Item': self._item(entry)}}
+                                                     for entry in entries[start:start + BATCH_WRITE_SIZE]]}
+            while request_items:
+                response = get_client().batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+
+    @timed('Outbox')
+    def pending(self, limit: int) -> list[OutboxEntry]:
+        # oldest first, i.e. in descending order of the negated ids
+        response = get_client().query(
+            TableName=get_table_name(),
+            ConsistentRead=True,
+            KeyConditionExpression='chat_id = :chat_id AND #ts < :zero',
+            ExpressionAttributeNames={'#ts': 'timestamp'},
+            ExpressionAttributeValues=encode_item({':chat_id': OUTBOX_CHAT_ID, ':zero': 0}),
+            ScanIndexForward=False,
+            Limit=limit
+        )
+        return [self._entry(item) for item in response['Items']]
+
+    @timed('Outbox')
+    def complete(self, ids: list[int]):
+        for start in range(0, len(ids), BATCH_WRITE_SIZE):
+            request_items: Any = {get_table_name(): [{'DeleteRequest': {'Key': encode_item({
+                'chat_id': OUTBOX_CHAT_ID,
+                'timestamp': -entry_id
+            })}} for entry_id in ids[start:start + BATCH_WRITE_SIZE]]}
+            while request_items:
+                response = get_client().batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+
+
+class SqliteOutbox:
+    # a connection per call, as the webhook and the consumer run in
+    # different threads of the polling process
+    def __init__(self, path: str = OUTBOX_PATH):
+        self.path = path
+        with self._connect() as connection:
+            # a new table, as outbox held a message per row before they were
+            # grouped in entries
+            connection.execute('CREATE TABLE IF NOT EXISTS outbox_entries (id INTEGER PRIMARY KEY, messages BLOB)')
+
+    def _connect(self) -> 'sqlite3.Connection':
+        # imported here as lambda never uses it
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=5)
+
+    def record(self, entries: list[OutboxEntry]):
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO outbox_entries VALUES (?, ?)',
+                                   [(entry['id'], _encode_messages(entry['messages'])) for entry in entries])
+
+    def pending(self, limit: int) -> list[OutboxEntry]:
+        with self._connect() as connection:
+            rows = connection.execute('SELECT id, messages FROM outbox_entries ORDER BY id LIMIT ?', (limit,)).fetchall()
+        return [OutboxEntry(id=entry_id, messages=_decode_messages(messages)) for entry_id, messages in rows]
+
+    def complete(self, ids: list[int]):
+        with self._connect() as connection:
+            connection.executemany('DELETE FROM outbox_entries WHERE id = ?', [(entry_id,) for entry_id in ids])
+
+
+_OUTBOX: Optional[Outbox] = None
+
+
+def get_outbox() -> Outbox:
+    global _OUTBOX
+    if _OUTBOX is None:
+        _OUTBOX = SqliteOutbox() if OUTBOX_BACKEND == 'sqlite' else DynamoDBOutbox()
+    return _OUTBOX
+
+
+class DeferredMessages:
+    # collects the messages of one update that can be sent after the webhook
+    # has been answered, such as the order summaries of /closejio, and
+    # records them in the outbox as one entry with record(); the key is the
+    # update id, or another number that is unique among keys, such as the
+    # time of a sweep
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+        self.messages: list[Tuple[int, str]] = []
+        # entries recorded so far, which later ones are numbered after
+        self.recorded = 0
+        self.token: Optional[Token[Optional[DeferredMessages]]] = None
+
+    def __enter__(self) -> 'DeferredMessages':
+        self.token = _DEFERRED_MESSAGES.set(self)
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        if self.token:
+            _DEFERRED_MESSAGES.reset(self.token)
+
+    def entry(self, messages: list[Tuple[int, str]]) -> OutboxEntry:
+        entry = OutboxEntry(id=self.update_id << OUTBOX_INDEX_BITS | self.recorded, messages=messages)
+        self.recorded += 1
+        return entry
+
+    def record(self):
+        if self.messages:
+            get_outbox().record([self.entry(self.messages)])
+            self.messages = []
+
+
+_DEFERRED_MESSAGES: ContextVar[Optional[DeferredMessages]] = ContextVar('deferred_messages', default=None)
+
+
+def defer_message(chat_id: int, text: str):
+    # sent right away outside of an update, e.g. from scripts
+    deferred_messages = _DEFERRED_MESSAGES.get()
+    if deferred_messages is None:
+        send_message(chat_id, text)
+    else:
+        deferred_messages.messages.append((chat_id, text))
+
+
+def defer_with(messages: list[Tuple[int, str]], commit: Callable[[list[dict[str, Any]]], bool]) -> bool:
+    # runs commit() with the writes to make in its transaction, e.g. the one
+    # closing a jio, and returns whether it committed; the messages are
+    # recorded in the outbox by the same transaction, so they are recorded
+    # if and only if it commits, or deferred after it for the sqlite outbox
+    # which is not part of it
+    deferred_messages = _DEFERRED_MESSAGES.get()
+    outbox = get_outbox()
+    if deferred_messages is not None and isinstance(outbox, DynamoDBOutbox):
+        return commit([outbox.transact_put(deferred_messages.entry(messages))])
+    if not commit([]):
+        return False
+    for chat_id, text in messages:
+        defer_message(chat_id, text)
+    return True
+
+
+def delivered(result: DispatchResult) -> bool:
+    # whether to remove the message from the outbox: sent, or rejected in a
+    # way that sending it again would not fix, e.g. the user blocked the bot
+    status_code = result['status_code']
+    return result['ok'] or (status_code != 0 and status_code != 429 and status_code < 500)
+
+
+def drain(limit: int = OUTBOX_BATCH_SIZE) -> int:
+    # sends pending messages in batches of entries until none are left and
+    # returns how many were removed from the outbox; a message is removed
+    # only after it was sent, so it is sent again if the consumer stops in
+    # between. There is one consumer at a time, the outbox function has a
+    # reserved concurrency of 1.
+    outbox = get_outbox()
+    sent = 0
+    while True:
+        entries = outbox.pending(limit)
+        if not entries:
+            return sent
+        results = iter(get_dispatcher().send_messages(
+            [message for entry in entries for message in entry['messages']]))
+        done: list[int] = []
+        # entries with messages left to retry, recorded again without the rest
+        retried: list[OutboxEntry] = []
+        for entry in entries:
+            left: list[Tuple[int, str]] = []
+            for message in entry['messages']:
+                result = next(results)
+                if delivered(result):
+                    sent += 1
+                else:
+                    left.append(message)
+                if not result['ok']:
+                    logger.info('failed to send to %d: %d after %d attempts',
+                                result['chat_id'], result['status_code'], result['attempts'])
+            if left:
+                retried.append(OutboxEntry(id=entry['id'], messages=left))
+            else:
+                done.append(entry['id'])
+        outbox.complete(done)
+        if retried:
+            outbox.record(retried)
+            # retried by the next drain rather than in a loop
+            return sent
+        if len(entries) < limit:
+            # the outbox was empty after this batch
+            return sent
+
+
+def lambda_handler(event: dict[str, Any], context: Any):
+    # triggered by new outbox items on the table's stream and on a schedule
+    # for retries; the stream records only signal that there is work
+    with metrics.UpdateMetrics():
+        metrics.set_property('Command', 'outbox')
+        sent = drain()
+        metrics.set_property('Sent', sent)
+    return {'sent': sent}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    print('sent %d messages' % drain())
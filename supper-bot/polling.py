@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import callback_data
+import metrics
+from app import process_update
+from dispatch import DISPATCH_WORKERS
+from outbox import drain
+from telegram import TELEGRAM_RETRY_WINDOW, Update, configure_client, get_client
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# seconds telegram holds a getUpdates request open while there are no updates
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', '30'))
+# updates of different chats handled at the same time
+POLLING_WORKERS = int(os.environ.get('POLLING_WORKERS', '16'))
+# seconds to wait after getUpdates failed
+POLLING_BACKOFF = 5.0
+# seconds between drains of the outbox, which this process consumes itself
+OUTBOX_INTERVAL = 1.0
+
+
+def update_chat_id(update: Update) -> int:
+    # the group chat an update acts on, callback queries arrive in the private
+    # chat with the user but carry the group chat id in their data
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        callback_query = update['callback_query']
+        try:
+            chat_id = callback_data.decode(callback_query['data'])[1]
+        except (KeyError, IndexError, ValueError):
+            chat_id = 0
+        return chat_id or callback_query['from']['id']
+    return 0
+
+
+def handle(update: Update):
+    # runs in a worker thread, with the same replies as the webhook except
+    # that message edits cannot be returned as a response
+    with metrics.UpdateMetrics():
+        try:
+            process_update(update, time.monotonic() + TELEGRAM_RETRY_WINDOW, webhook_reply=False)
+        except Exception:
+            logger.exception('Error while processing update: %s', update)
+
+
+class ChatScheduler:
+    # handles updates of different chats concurrently and the updates of one
+    # chat strictly in the order they arrived
+    def __init__(self):
+        self.pending: dict[int, collections.deque[Update]] = {}
+        self.tasks: set[asyncio.Task[None]] = set()
+
+    def submit(self, update: Update):
+        chat_id = update_chat_id(update)
+        if chat_id in self.pending:
+            self.pending[chat_id].append(update)
+            return
+        self.pending[chat_id] = collections.deque([update])
+        task = asyncio.create_task(self._drain(chat_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _drain(self, chat_id: int):
+        pending = self.pending[chat_id]
+        while pending:
+            # to_thread() copies the context, so each update has its own
+            # unit of work, outbound queue and metrics
+            await asyncio.to_thread(handle, pending[0])
+            pending.popleft()
+        del self.pending[chat_id]
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+async def consume_outbox(finished: asyncio.Event):
+    # sends the messages deferred by handled updates, and once more after
+    # the last update has been handled
+    while True:
+        try:
+            await asyncio.to_thread(drain)
+        except Exception:
+            logger.exception('Error while draining the outbox')
+        if finished.is_set():
+            return
+        try:
+            await asyncio.wait_for(finished.wait(), OUTBOX_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def get_updates(offset: int, timeout: int) -> Optional[list[Update]]:
+    # returns None if getUpdates failed, e.g. while a webhook is still set
+    import requests
+    try:
+        response = get_client().post('getUpdates', {
+            'offset': offset,
+            'timeout': timeout,
+            'allowed_updates': '["message", "callback_query"]'
+        }, read_timeout=timeout + TELEGRAM_RETRY_WINDOW)
+    except requests.RequestException:
+        logger.exception('getUpdates failed')
+        return None
+    if response.status_code != 200:
+        logger.error('getUpdates returned %d: %s', response.status_code, response.text)
+        return None
+    return response.json()['result']
+
+
+async def poll(timeout: int = POLLING_TIMEOUT, workers: int = POLLING_WORKERS):
+    loop = asyncio.get_running_loop()
+    # two more threads for the getUpdates request and the outbox
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=workers + 2))
+    # a connection for each worker, getUpdates and each thread of the
+    # dispatcher sending the outbox
+    configure_client(workers + 1 + DISPATCH_WORKERS)
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    scheduler = ChatScheduler()
+    finished = asyncio.Event()
+    consumer = asyncio.ensure_future(consume_outbox(finished))
+    offset = 0
+    while not stopping.is_set():
+        request = asyncio.ensure_future(asyncio.to_thread(get_updates, offset, timeout))
+        stopped = asyncio.ensure_future(stopping.wait())
+        await asyncio.wait([request, stopped], return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+        if not request.done():
+            # updates fetched by the abandoned request are redelivered with
+            # the same offset next time
+            break
+        updates = request.result()
+        if updates is None:
+            await asyncio.sleep(POLLING_BACKOFF)
+            continue
+        for update in updates:
+            # confirmed with the next getUpdates call
+            offset = update['update_id'] + 1
+            scheduler.submit(update)
+    logger.info('stopping, waiting for %d chats', len(scheduler.pending))
+    await scheduler.join()
+    if offset:
+        # confirm the last updates handled, which the next run would
+        # otherwise process again with the memory ledger; this also ends an
+        # abandoned getUpdates request
+        if await asyncio.to_thread(get_updates, offset, 0) is None:
+            logger.warning('could not confirm updates before %d', offset)
+    finished.set()
+    await consumer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the bot by long polling getUpdates instead of behind a webhook.')
+    parser.add_argument('--timeout', type=int, default=POLLING_TIMEOUT, help='seconds getUpdates is held open')
+    parser.add_argument('--workers', type=int, default=POLLING_WORKERS, help='updates handled at the same time')
+    options = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    asyncio.run(poll(options.timeout, options.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import enum
+from collections import Counter
+from typing import TYPE_CHECKING, Tuple, TypedDict
+
+if TYPE_CHECKING:
+    from jio import ItemTypeDef, OrderListTypeDef
+
+GST_PERCENT = 7
+
+
+class Split(enum.Enum):
+    EQUALLY = 'equally'
+    WEIGHTED = 'weighted'
+    FREE = 'free'
+
+
+class UserSettlement(TypedDict):
+    user_id: str
+    firstname: str
+    subtotal: int
+    gst: int
+    delivery: int
+    total: int
+
+
+class Settlement(TypedDict):
+    split: Split
+    gst_included: bool
+    # item -> quantity
+    items: dict[str, int]
+    users: list[UserSettlement]
+    subtotal: int
+    gst: int
+    delivery: int
+    total: int
+
+
+def allocate(amount: int, weights: list[int]) -> list[int]:
+    # splits amount in proportion to weights so that the shares add up to
+    # amount exactly, the cents left over after rounding down go to the
+    # largest remainders, ties to the earliest
+    total_weight = sum(weights)
+    if not total_weight:
+        return [0] * len(weights)
+    shares = [amount * weight // total_weight for weight in weights]
+    leftover = amount - sum(shares)
+    if leftover:
+        remainders = sorted(range(len(weights)), key=lambda i: -(amount * weights[i] % total_weight))
+        for i in remainders[:leftover]:
+            shares[i] += 1
+    return shares
+
+
+def aggregate(items: list['ItemTypeDef']) -> Tuple[dict[str, int], int]:
+    # the running totals kept with each order: quantity of each item and subtotal
+    counts = Counter(item['item'] for item in items)
+    return dict(counts), sum(int(item['price']) for item in items)
+
+
+def settle(orders: dict[str, 'OrderListTypeDef'], split: Split, gst_included: bool, delivery: int) -> Settlement:
+    # works from the running totals of each order, so it costs one pass over
+    # the users rather than over every item ordered
+    counts: Counter[str] = Counter()
+    users: list[UserSettlement] = []
+    # users without items do not pay
+    for user_id, order in orders.items():
+        if not order['items']:
+            continue
+        counts.update(order['counts'])
+        # ints from codec.py, decimals if read through the boto3 resource layer
+        subtotal = int(order['subtotal'])
+        users.append(UserSettlement(user_id=user_id, firstname=order['firstname'],
+                                    subtotal=subtotal, gst=0, delivery=0, total=subtotal))
+    items = {item: int(count) for item, count in counts.items() if count}
+    delivery = int(delivery)
+    subtotal = sum(user['subtotal'] for user in users)
+    subtotals = [user['subtotal'] for user in users]
+    # gst on the jio subtotal rounded half up, then shared by subtotal
+    gst = (subtotal * GST_PERCENT + 50) // 100 if gst_included else 0
+    if not users:
+        delivery = 0
+    # with a free delivery the fee stays in the grand total, as whoever
+    # places the order pays it, but no user is charged a share
+    if split == Split.FREE:
+        delivery_shares = [0] * len(users)
+    elif split == Split.WEIGHTED and subtotal:
+        delivery_shares = allocate(delivery, subtotals)
+    else:
+        delivery_shares = allocate(delivery, [1] * len(users))
+    for user, user_gst, user_delivery in zip(users, allocate(gst, subtotals), delivery_shares):
+        user['gst'] = user_gst
+        user['delivery'] = user_delivery
+        user['total'] = user['subtotal'] + user_gst + user_delivery
+    return Settlement(split=split, gst_included=gst_included, items=items, users=users,
+                      subtotal=subtotal, gst=gst, delivery=delivery, total=subtotal + gst + delivery)
+
+
+def summarise(settlement: Settlement) -> Tuple[str, dict[str, str]]:
+    # the group summary and the message to each user who ordered
+    if not settlement['users']:
+        return 'Jio is closed! There were no items ordered.', {}
+    order_summary = ['Jio is closed! Here are the items ordered:\n']
+    for item, count in settlement['items'].items():
+        order_summary.append('%s x %d' % (item, count))
+    order_summary.append('\nPlease pay per person total:\n')
+    user_messages: dict[str, str] = {}
+    for user in settlement['users']:
+        user_inclusions: list[str] = []
+        if settlement['split'] != Split.FREE:
+            user_inclusions.append('$%.2f delivery' % (user['delivery']/100))
+        if settlement['gst_included']:
+            user_inclusions.append('$%.2f GST' % (user['gst']/100))
+        user_inclusion_string = ' (incl. %s)' % (' & '.join(user_inclusions)) if user_inclusions else ''
+        order_summary.append('%s - $%.2f%s' % (user['firstname'], user['total']/100, user_inclusion_string))
+        user_messages[user['user_id']] = 'Your food order costs *$%.2f* in total%s' % (
+            user['total']/100,
+            user_inclusion_string
+        )
+    grand_total_summary = '\n*Grand Total* - $%.2f' % (settlement['total']/100)
+    if settlement['gst_included']:
+        grand_total_summary += ' (GST $%.2f included)' % (settlement['gst']/100)
+    else:
+        grand_total_summary += ' (GST not included)'
+    order_summary.append(grand_total_summary)
+    return '\n'.join(order_summary), user_messages
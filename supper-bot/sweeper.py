@@ -0,0 +1,68 @@
+import logging
+import os
+import time
+from typing import Any, Optional
+
+import metrics
+from jio import Jio
+from outbox import DeferredMessages, defer_with, drain
+from settlement import summarise
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+MESSAGE_AUTO_CLOSED = 'Closing time of %d mins reached.\n\n%s'
+# the messages of a sweep are recorded in the outbox under this plus the
+# time it ran, above any telegram update id
+SWEEP_KEY_OFFSET = 1 << 32
+
+
+def close_due(now: int) -> int:
+    # closes every open jio past its closing time and returns how many were
+    # closed; the order summary of each chat and the amount owed by each user
+    # are recorded in the outbox by the transaction that closes the jio, so a
+    # jio that fails to close does not hold back the messages of the others
+    closed = 0
+    with DeferredMessages(SWEEP_KEY_OFFSET + now) as deferred_messages:
+        for chat_id, opened in Jio.due(now):
+            try:
+                jio: Optional[Jio] = Jio._load(chat_id)
+                # closed by its starter or replaced since the index was updated
+                if jio is None or jio.timestamp != opened:
+                    continue
+                settlement = jio.settle()
+                order_summary, user_messages = summarise(settlement)
+                messages = [(chat_id, MESSAGE_AUTO_CLOSED % (jio.closes, order_summary))]
+                messages.extend((int(user_id), message) for user_id, message in user_messages.items())
+                if not defer_with(messages, lambda writes: jio.close(settlement, writes)):
+                    logger.info('chat %d: jio closed concurrently, skipped', chat_id)
+                    continue
+                closed += 1
+                # for the sqlite outbox, which the close is not part of
+                deferred_messages.record()
+            except Exception:
+                # retried by the next sweep if the jio is still open
+                logger.exception('chat %d: failed to close jio', chat_id)
+    return closed
+
+
+def sweep(now: Optional[int] = None) -> int:
+    now = int(time.time()) if now is None else now
+    closed = close_due(now)
+    logger.info('closed %d jios', closed)
+    return closed
+
+
+def lambda_handler(event: dict[str, Any], context: Any):
+    # invoked on a schedule rather than by telegram
+    with metrics.UpdateMetrics():
+        metrics.set_property('Command', 'sweep')
+        closed = sweep()
+        metrics.set_property('Closed', closed)
+    return {'closed': closed}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    # without lambda there is no outbox function to send the messages
+    print('closed %d jios, sent %d messages' % (sweep(), drain()))
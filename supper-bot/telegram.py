@@ -1,13 +1,32 @@
+import enum
 import json
 import logging
 import os
-from typing import Any, List, Literal, Optional, TypedDict
+import re
+import time
+from contextvars import ContextVar, Token
+from typing import TYPE_CHECKING, Any, List, Literal, Optional, Tuple, TypedDict, Union
 
-import requests
+from metrics import timed
+
+if TYPE_CHECKING:
+    import requests
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+# connections kept open to the bot api, at least as many as concurrent sends
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '10'))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', '1'))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', '2'))
+# answer webhook updates with a bot api method instead of a separate request
+WEBHOOK_REPLY = os.environ.get('WEBHOOK_REPLY', '1') == '1'
+# retries of 429 and 5xx responses back off from this many seconds
+TELEGRAM_RETRY_BACKOFF = 0.1
+# how long to keep retrying outside of an OutboundQueue
+TELEGRAM_RETRY_WINDOW = 2.0
 
 
 class _InlineKeyboardButton(TypedDict):
@@ -23,6 +42,11 @@ class InlineKeyboardMarkup(TypedDict):
     inline_keyboard: List[List[InlineKeyboardButton]]
 
 
+# a str is a reply_markup that has already been serialized, e.g. a cached
+# menu keyboard
+ReplyMarkup = Union[InlineKeyboardMarkup, str]
+
+
 class _User(TypedDict):
     id: int
     is_bot: bool
@@ -79,7 +103,7 @@ class CallbackQuery(_CallbackQuery, total=False):
 
 
 class _Update(TypedDict):
-    id: int
+    update_id: int
 
 
 class Update(_Update, total=False):
@@ -87,7 +111,87 @@ class Update(_Update, total=False):
     callback_query: CallbackQuery
 
 
-def _send_edit_message(endpoint: str, chat_id: int, text: str, message_id: Optional[int] = None, reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+class TelegramClient:
+    # keeps connections to the bot api alive across warm lambda invocations
+    def __init__(self, token: str, api_url: str = TELEGRAM_API_URL, pool_size: int = TELEGRAM_POOL_SIZE):
+        self.base_url = '%s/bot%s/' % (api_url, token)
+        self.timeout = (TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+        # imported on first use, updates that are dropped never need it
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, endpoint: str, data: dict[str, Any], read_timeout: Optional[float] = None) -> 'requests.Response':
+        timeout = self.timeout if read_timeout is None else (self.timeout[0], read_timeout)
+        return self.session.post(self.base_url + endpoint, data=data, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+_CLIENT: Optional[TelegramClient] = None
+
+
+def get_client() -> TelegramClient:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = TelegramClient(os.environ['BOT_TOKEN'])
+    return _CLIENT
+
+
+def configure_client(pool_size: int):
+    # replaces the client with one that keeps as many connections open, for
+    # processes that send from more threads than lambda, e.g. polling.py;
+    # requests beyond the pool size would open connections that are then
+    # discarded instead of kept alive
+    global _CLIENT
+    if _CLIENT is not None:
+        _CLIENT.close()
+    _CLIENT = TelegramClient(os.environ['BOT_TOKEN'], pool_size=pool_size)
+
+
+class Outcome(enum.Enum):
+    OK = 'ok'
+    RATE_LIMITED = 'rate_limited'  # 429, retry after the given time
+    SERVER_ERROR = 'server_error'  # 5xx or the bot api could not be reached
+    FORBIDDEN = 'forbidden'  # the user has not started a chat with the bot or blocked it
+    BAD_REQUEST = 'bad_request'
+
+
+RETRYABLE_OUTCOMES = (Outcome.RATE_LIMITED, Outcome.SERVER_ERROR)
+
+
+def classify(response: Optional['requests.Response']) -> Outcome:
+    if response is None or response.status_code >= 500:
+        return Outcome.SERVER_ERROR
+    if response.status_code == 200:
+        return Outcome.OK
+    if response.status_code == 429:
+        return Outcome.RATE_LIMITED
+    if response.status_code == 403:
+        return Outcome.FORBIDDEN
+    # sending to a user who never started a chat with the bot
+    if response.status_code == 400 and 'chat not found' in response.text:
+        return Outcome.FORBIDDEN
+    return Outcome.BAD_REQUEST
+
+
+def retry_after(response: 'requests.Response') -> float:
+    try:
+        return response.json()['parameters']['retry_after']
+    except (ValueError, KeyError):
+        return 1
+
+
+def escape_markdown(text: str) -> str:
+    # for user input shown in messages sent with parse_mode Markdown
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+
+def message_data(chat_id: int, text: str, message_id: Optional[int] = None, reply_markup: Optional[ReplyMarkup] = None) -> dict[str, Any]:
     data: dict[str, Any] = {
         'chat_id': chat_id,
         'text': text,
@@ -96,31 +200,100 @@ def _send_edit_message(endpoint: str, chat_id: int, text: str, message_id: Optio
     if message_id:
         data['message_id'] = message_id
     if reply_markup:
-        data['reply_markup'] = json.dumps(reply_markup)
-    response = requests.post(
-        url='https://api.telegram.org/bot%s/%s' % (
-            os.environ['BOT_TOKEN'], endpoint),
-        data=data
-    )
-    logger.info('status_code: %d' % response.status_code)
+        data['reply_markup'] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
+    return data
+
+
+@timed('Telegram')
+def post(endpoint: str, data: dict[str, Any]) -> Optional['requests.Response']:
+    # returns None if the bot api could not be reached
+    import requests
+    try:
+        response = get_client().post(endpoint, data)
+    except requests.RequestException:
+        logger.exception('%s failed', endpoint)
+        return None
+    logger.info('status_code: %d', response.status_code)
     logger.debug(response.content)
-    return response.status_code == 200
-
-
-def send_message(chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
-    return _send_edit_message(
-        endpoint='sendMessage',
-        chat_id=chat_id,
-        text=text,
-        reply_markup=reply_markup
-    )
-
-
-def edit_message_text(chat_id: int, message_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
-    return _send_edit_message(
-        endpoint='editMessageText',
-        chat_id=chat_id,
-        message_id=message_id,
-        text=text,
-        reply_markup=reply_markup
-    )
+    return response
+
+
+def request(endpoint: str, data: dict[str, Any], deadline: float) -> Outcome:
+    # retries rate limits and server errors while the retry fits before the
+    # deadline, a time.monotonic() value
+    backoff = TELEGRAM_RETRY_BACKOFF
+    while True:
+        response = post(endpoint, data)
+        outcome = classify(response)
+        if outcome not in RETRYABLE_OUTCOMES:
+            return outcome
+        if outcome == Outcome.RATE_LIMITED:
+            wait = retry_after(response)
+        else:
+            wait = backoff
+            backoff *= 2
+        if time.monotonic() + wait >= deadline:
+            logger.info('%s %s, not retrying past the deadline', endpoint, outcome.value)
+            return outcome
+        time.sleep(wait)
+
+
+class OutboundQueue:
+    # collects the message edits of one update and sends them on flush(),
+    # repeated edits of a message are coalesced into the last one and the
+    # first edited message can be returned as the webhook response instead;
+    # sendMessage is never queued as callers act on its outcome
+    def __init__(self, deadline: float, webhook_reply: bool = WEBHOOK_REPLY):
+        self.deadline = deadline
+        self.webhook_reply = webhook_reply
+        self.edits: dict[Tuple[int, int], dict[str, Any]] = {}
+        self.coalesced = 0
+        self.token: Optional[Token[Optional[OutboundQueue]]] = None
+
+    def __enter__(self) -> 'OutboundQueue':
+        self.token = _OUTBOUND_QUEUE.set(self)
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        if self.token:
+            _OUTBOUND_QUEUE.reset(self.token)
+
+    def edit(self, data: dict[str, Any]):
+        key = (data['chat_id'], data['message_id'])
+        if key in self.edits:
+            self.coalesced += 1
+        self.edits[key] = data
+
+    def flush(self) -> Optional[dict[str, Any]]:
+        # returns the webhook response body, if any
+        body: Optional[dict[str, Any]] = None
+        for data in self.edits.values():
+            if self.webhook_reply and body is None:
+                body = dict(method='editMessageText', **data)
+            else:
+                request('editMessageText', data, self.deadline)
+        self.edits = {}
+        return body
+
+
+_OUTBOUND_QUEUE: ContextVar[Optional[OutboundQueue]] = ContextVar('outbound_queue', default=None)
+
+
+def send_message(chat_id: int, text: str, reply_markup: Optional[ReplyMarkup] = None) -> Outcome:
+    outbound_queue = _OUTBOUND_QUEUE.get()
+    deadline = outbound_queue.deadline if outbound_queue else time.monotonic() + TELEGRAM_RETRY_WINDOW
+    return request('sendMessage', message_data(chat_id, text, reply_markup=reply_markup), deadline)
+
+
+def edit_message_text(chat_id: int, message_id: int, text: str, reply_markup: Optional[ReplyMarkup] = None) -> Outcome:
+    if not message_id:
+        # e.g. the error reply of a flow started by a command rather than a
+        # button, which has no message to edit
+        logger.info('no message to edit in chat %d, dropped: %s', chat_id, text)
+        return Outcome.BAD_REQUEST
+    data = message_data(chat_id, text, message_id, reply_markup)
+    outbound_queue = _OUTBOUND_QUEUE.get()
+    if outbound_queue:
+        outbound_queue.edit(data)
+        return Outcome.OK
+    return request('editMessageText', data, time.monotonic() + TELEGRAM_RETRY_WINDOW)
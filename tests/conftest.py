@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+# the bot's modules import each other by name, as in lambda; the stand-ins
+# come after them as benchmarks/ has a callback_data.py of its own
+sys.path.insert(0, os.path.join(ROOT, 'supper-bot'))
+sys.path.append(os.path.join(ROOT, 'benchmarks'))
+
+os.environ.setdefault('BOT_URL', 't.me/test')
+os.environ.setdefault('TABLE_NAME', 'test')
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    import jio
+    from stub_dynamodb import StubDynamoDB
+    dynamodb = StubDynamoDB(indexes={jio.DUE_INDEX: ('status', 'closes_at')})
+    monkeypatch.setattr(jio, '_DYNAMODB_CLIENT', dynamodb)
+    return dynamodb
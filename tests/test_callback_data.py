@@ -0,0 +1,40 @@
+import pytest
+
+import callback_data
+from callback_data import CALLBACK_DATA_LIMIT, COMMANDS
+
+
+@pytest.mark.parametrize('command', COMMANDS)
+@pytest.mark.parametrize('chat_id', [0, 1, -1, 255, -128, 123456789, -1001234567890, -1009999999999999])
+@pytest.mark.parametrize('path', [[], [0], [3, 1, 0, 2], [9, 9, 9, 9, 9, 9], [254], [255, 300, 0], [1, 65535]])
+def test_round_trip(command, chat_id, path):
+    data = callback_data.encode(command, chat_id, path)
+    assert len(data) <= CALLBACK_DATA_LIMIT
+    assert callback_data.decode(data) == (command, chat_id, path)
+
+
+def test_compact():
+    assert callback_data.encode('additem', -1001234567890, [3, 1, 0, 2]) == '223102.-cryl7kya'
+
+
+def test_wide_indices_use_the_binary_form():
+    data = callback_data.encode('additem', -1001234567890, [3, 64])
+    assert data.startswith(callback_data.VERSION)
+    assert callback_data.decode(data) == ('additem', -1001234567890, [3, 64])
+
+
+@pytest.mark.parametrize('path', [[], [3, 1, 0, 2], [63]])
+def test_binary_form_of_existing_buttons(path):
+    data = callback_data._encode_binary('removeitem', -1001234567890, path)
+    assert callback_data.decode(data) == ('removeitem', -1001234567890, path)
+
+
+def test_too_long():
+    with pytest.raises(ValueError):
+        callback_data.encode('additem', -1001234567890, [300] * 20)
+
+
+def test_legacy():
+    assert callback_data.decode('additem_-1001234567890_3_1_0_2') == ('additem', -1001234567890, [3, 1, 0, 2])
+    assert callback_data.decode('openjio_-100123') == ('openjio', -100123, [])
+    assert callback_data.decode('cancel') == ('cancel', 0, [])
@@ -0,0 +1,89 @@
+import time
+
+from jio import JIO_DELIVERY, JIO_GST, JIO_MAX_AGE, JIO_SPLIT, JIO_TYPE, POPULARITY_TIMESTAMP, USER_POPULARITY_TIMESTAMP, Jio
+
+CHAT_ID = -100
+
+
+def open_jio(users):
+    assert Jio.create(CHAT_ID, 1, JIO_TYPE[0], 15, JIO_SPLIT[0], JIO_GST[0], JIO_DELIVERY)
+    jio = Jio.exists(CHAT_ID)
+    for user_id in range(1, users + 1):
+        jio.add_item(user_id, 'User %d' % user_id, 'Teh Ping', 150)
+    return jio
+
+
+def orders(dynamodb):
+    return [key for key in dynamodb.items if key[0] == CHAT_ID and key[1] < 0]
+
+
+def test_close_deletes_the_orders(dynamodb):
+    for users in (3, 150):
+        assert open_jio(users).close()
+        assert orders(dynamodb) == []
+    # the next jio reads its own header and nothing else
+    open_jio(0)
+    dynamodb.reset()
+    jio = Jio.exists(CHAT_ID)
+    assert jio.orders == {}
+    assert dynamodb.calls == {'Query': 1}
+
+
+def test_replacing_an_abandoned_jio_deletes_its_orders(dynamodb):
+    open_jio(3)
+    # as if opened before JIO_MAX_AGE
+    for key, item in dynamodb.items.items():
+        if key[0] == CHAT_ID and 'opened' in item:
+            item['opened'] -= JIO_MAX_AGE + 60
+    open_jio(0)
+    assert orders(dynamodb) == []
+    archived = [item for key, item in dynamodb.items.items() if key[0] == CHAT_ID and POPULARITY_TIMESTAMP < key[1] < USER_POPULARITY_TIMESTAMP]
+    assert [(item['status'], item['users']) for item in archived] == [('Open', 3)]
+    assert archived[0]['timestamp'] < int(time.time()) - JIO_MAX_AGE
+
+
+def legacy_order(dynamodb, jio, user_id, *items):
+    # an order written before orders kept running totals
+    dynamodb.items[(CHAT_ID, -user_id)] = {
+        'chat_id': CHAT_ID,
+        'timestamp': -user_id,
+        'opened': jio.timestamp,
+        'firstname': 'User %d' % user_id,
+        'items': [{'item': item, 'price': price} for item, price in items]
+    }
+
+
+def test_untotalled_order_is_written_whole(dynamodb):
+    jio = open_jio(0)
+    legacy_order(dynamodb, jio, 1, ('Teh Ping', 150), ('Milo', 200))
+    jio = Jio._load(CHAT_ID)
+    assert jio.untotalled == {'1'}
+    assert jio.add_item(1, 'User 1', 'Teh Ping', 150)
+    assert jio.untotalled == set()
+    stored = dynamodb.items[(CHAT_ID, -1)]
+    assert (stored['counts'], stored['subtotal']) == ({'Teh Ping': 2, 'Milo': 1}, 500)
+    # later adds update the order in place
+    assert jio.add_item(1, 'User 1', 'Milo', 200)
+    assert Jio._load(CHAT_ID).orders['1']['counts'] == {'Teh Ping': 2, 'Milo': 2}
+
+
+def test_untotalled_item_is_removed_whole(dynamodb):
+    jio = open_jio(0)
+    legacy_order(dynamodb, jio, 1, ('Teh Ping', 150), ('Milo', 200))
+    jio = Jio._load(CHAT_ID)
+    assert jio.remove_item(1, 0)
+    assert jio.untotalled == set()
+    stored = dynamodb.items[(CHAT_ID, -1)]
+    assert (stored['items'], stored['counts'], stored['subtotal']) == ([{'item': 'Milo', 'price': 200}], {'Milo': 1}, 200)
+
+
+def test_stale_remove_is_refused(dynamodb):
+    jio = open_jio(0)
+    legacy_order(dynamodb, jio, 1, ('Teh Ping', 150), ('Milo', 200))
+    jio.add_items(2, 'User 2', [{'item': 'Teh Ping', 'price': 150}, {'item': 'Milo', 'price': 200}])
+    for user_id in (1, 2):
+        # the same keyboard tapped twice, or a redelivered update
+        first, second = Jio._load(CHAT_ID), Jio._load(CHAT_ID)
+        assert first.remove_item(user_id, 0)
+        assert not second.remove_item(user_id, 0)
+        assert [item['item'] for item in Jio._load(CHAT_ID).orders[str(user_id)]['items']] == ['Milo']
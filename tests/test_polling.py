@@ -0,0 +1,32 @@
+import asyncio
+import os
+import signal
+import threading
+
+import polling
+
+
+def test_last_updates_are_confirmed_on_exit(monkeypatch):
+    monkeypatch.setenv('BOT_TOKEN', 'test')
+    handled = []
+    requests = []
+    stopped = threading.Event()
+
+    def get_updates(offset, timeout):
+        requests.append((offset, timeout))
+        if len(requests) == 1:
+            return [{'update_id': 10, 'message': {'chat': {'id': -1}}},
+                    {'update_id': 11, 'message': {'chat': {'id': -2}}}]
+        if timeout:
+            # stopped while the next request is held open
+            os.kill(os.getpid(), signal.SIGTERM)
+            stopped.wait(5)
+            return []
+        stopped.set()
+        return []
+    monkeypatch.setattr(polling, 'get_updates', get_updates)
+    monkeypatch.setattr(polling, 'process_update', lambda update, deadline, webhook_reply: handled.append(update))
+    monkeypatch.setattr(polling, 'drain', lambda: 0)
+    asyncio.run(polling.poll(timeout=30, workers=2))
+    assert sorted(update['update_id'] for update in handled) == [10, 11]
+    assert requests == [(0, 30), (12, 30), (12, 0)]
@@ -0,0 +1,37 @@
+from jio import POPULARITY_KEPT, POPULARITY_SLACK, POPULARITY_TIMESTAMP, get_favourites, record_popularity
+
+CHAT_ID = -100
+
+
+def test_favourites_of_the_user_come_before_the_chat(dynamodb):
+    record_popularity(CHAT_ID, 1, {'Teh Ping': 1, 'Milo Dinosaur': 3})
+    record_popularity(CHAT_ID, 2, {'Roti Prata': 5})
+    assert get_favourites(CHAT_ID, 1) == ['Milo Dinosaur', 'Teh Ping', 'Roti Prata']
+    assert get_favourites(CHAT_ID, 2) == ['Roti Prata', 'Milo Dinosaur', 'Teh Ping']
+    assert get_favourites(CHAT_ID, 3) == ['Roti Prata', 'Milo Dinosaur', 'Teh Ping']
+    assert dynamodb.calls['BatchGetItem'] == 3
+
+
+def test_chat_item_does_not_hold_user_counts(dynamodb):
+    for user_id in range(1, 50):
+        record_popularity(CHAT_ID, user_id, {'Teh Ping': 1})
+    assert dynamodb.items[(CHAT_ID, POPULARITY_TIMESTAMP)]['item:Teh Ping'] == 49
+    assert len(dynamodb.items[(CHAT_ID, POPULARITY_TIMESTAMP)]) == 3
+
+
+def test_least_added_counters_are_trimmed(dynamodb):
+    record_popularity(CHAT_ID, 1, {'Teh Ping': 2})
+    for index in range(POPULARITY_KEPT + POPULARITY_SLACK):
+        record_popularity(CHAT_ID, 1, {'Item %d' % index: 1})
+    chat = dynamodb.items[(CHAT_ID, POPULARITY_TIMESTAMP)]
+    assert len(chat) - 2 == POPULARITY_KEPT
+    assert get_favourites(CHAT_ID, 1)[0] == 'Teh Ping'
+
+
+def test_legacy_user_counters_are_trimmed(dynamodb):
+    dynamodb.items[(CHAT_ID, POPULARITY_TIMESTAMP)] = dict(
+        {'chat_id': CHAT_ID, 'timestamp': POPULARITY_TIMESTAMP, 'item:Teh Ping': 3},
+        **{'user:%d:Teh Ping' % user_id: 1 for user_id in range(POPULARITY_KEPT + POPULARITY_SLACK)})
+    record_popularity(CHAT_ID, 1, {'Milo Dinosaur': 1})
+    assert sorted(dynamodb.items[(CHAT_ID, POPULARITY_TIMESTAMP)]) == [
+        'chat_id', 'item:Milo Dinosaur', 'item:Teh Ping', 'timestamp']
@@ -0,0 +1,83 @@
+from settlement import Split, aggregate, allocate, settle, summarise
+
+
+def order(firstname, *prices):
+    items = [{'item': 'Item %d' % price, 'price': price} for price in prices]
+    counts, subtotal = aggregate(items)
+    return {'firstname': firstname, 'items': items, 'counts': counts, 'subtotal': subtotal}
+
+
+def test_allocate_adds_up_exactly():
+    for amount in (0, 1, 299, 300, 301, 12345):
+        for weights in ([1], [1, 1, 1], [150, 990, 1200], [7, 0, 3]):
+            assert sum(allocate(amount, weights)) == amount
+
+
+def test_allocate_leftover_goes_to_largest_remainder_then_earliest():
+    assert allocate(100, [1, 1, 1]) == [34, 33, 33]
+    assert allocate(10, [1, 2]) == [3, 7]
+    assert allocate(5, [3, 3]) == [3, 2]
+
+
+def test_allocate_without_weight():
+    assert allocate(300, [0, 0]) == [0, 0]
+    assert allocate(300, []) == []
+
+
+def test_aggregate():
+    counts, subtotal = aggregate([{'item': 'A', 'price': 150}, {'item': 'B', 'price': 200}, {'item': 'A', 'price': 150}])
+    assert counts == {'A': 2, 'B': 1}
+    assert subtotal == 500
+
+
+def test_settle_equally():
+    settlement = settle({'1': order('A', 500), '2': order('B', 1000), '3': order('C', 250)},
+                        Split.EQUALLY, False, 300)
+    assert [user['delivery'] for user in settlement['users']] == [100, 100, 100]
+    assert [user['total'] for user in settlement['users']] == [600, 1100, 350]
+    assert settlement['total'] == 1750 + 300
+
+
+def test_settle_weighted_with_gst_reconciles():
+    settlement = settle({'1': order('A', 333), '2': order('B', 667, 150), '3': order('C', 1)},
+                        Split.WEIGHTED, True, 300)
+    assert settlement['subtotal'] == 1151
+    # 7% of the jio subtotal, rounded half up
+    assert settlement['gst'] == 81
+    assert sum(user['gst'] for user in settlement['users']) == settlement['gst']
+    assert sum(user['delivery'] for user in settlement['users']) == 300
+    assert sum(user['total'] for user in settlement['users']) == settlement['total'] == 1151 + 81 + 300
+
+
+def test_settle_free_delivery_is_not_charged_to_users():
+    settlement = settle({'1': order('A', 500), '2': order('B', 1000)}, Split.FREE, False, 300)
+    assert [user['delivery'] for user in settlement['users']] == [0, 0]
+    assert [user['total'] for user in settlement['users']] == [500, 1000]
+    # the fee is still part of the grand total
+    assert settlement['delivery'] == 300
+    assert settlement['total'] == 1800
+
+
+def test_settle_skips_users_without_items():
+    settlement = settle({'1': order('A', 500), '2': order('B')}, Split.EQUALLY, False, 300)
+    assert [user['user_id'] for user in settlement['users']] == ['1']
+    assert settlement['users'][0]['delivery'] == 300
+
+
+def test_settle_without_orders():
+    settlement = settle({}, Split.EQUALLY, True, 300)
+    assert settlement['users'] == []
+    assert settlement['total'] == 0
+    assert summarise(settlement) == ('Jio is closed! There were no items ordered.', {})
+
+
+def test_summarise():
+    settlement = settle({'1': order('A', 500, 500), '2': order('B', 1000)}, Split.EQUALLY, True, 300)
+    order_summary, user_messages = summarise(settlement)
+    assert 'Item 500 x 2' in order_summary
+    assert 'A - $12.20 (incl. $1.50 delivery & $0.70 GST)' in order_summary
+    assert '*Grand Total* - $24.40 (GST $1.40 included)' in order_summary
+    assert user_messages == {
+        '1': 'Your food order costs *$12.20* in total (incl. $1.50 delivery & $0.70 GST)',
+        '2': 'Your food order costs *$12.20* in total (incl. $1.50 delivery & $0.70 GST)'
+    }
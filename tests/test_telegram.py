@@ -0,0 +1,50 @@
+import time
+
+import telegram
+from telegram import OutboundQueue, Outcome, edit_message_text
+
+
+def deadline():
+    return time.monotonic() + 2
+
+
+def test_repeated_edits_are_coalesced():
+    with OutboundQueue(deadline(), webhook_reply=True) as outbound_queue:
+        edit_message_text(1, 10, 'first')
+        edit_message_text(1, 10, 'second')
+        edit_message_text(1, 11, 'other')
+    assert outbound_queue.coalesced == 1
+    assert [data['text'] for data in outbound_queue.edits.values()] == ['second', 'other']
+
+
+def test_first_edit_is_the_webhook_reply(monkeypatch):
+    sent = []
+    monkeypatch.setattr(telegram, 'request', lambda endpoint, data, deadline: sent.append((endpoint, data)))
+    with OutboundQueue(deadline(), webhook_reply=True) as outbound_queue:
+        edit_message_text(1, 10, 'reply', {'inline_keyboard': []})
+        edit_message_text(2, 20, 'sent')
+    body = outbound_queue.flush()
+    assert body == {'method': 'editMessageText', 'chat_id': 1, 'message_id': 10, 'text': 'reply',
+                    'parse_mode': 'Markdown', 'reply_markup': '{"inline_keyboard": []}'}
+    assert [(endpoint, data['chat_id']) for endpoint, data in sent] == [('editMessageText', 2)]
+    assert outbound_queue.edits == {}
+
+
+def test_without_webhook_reply_every_edit_is_sent(monkeypatch):
+    sent = []
+    monkeypatch.setattr(telegram, 'request', lambda endpoint, data, deadline: sent.append(data['message_id']))
+    with OutboundQueue(deadline(), webhook_reply=False) as outbound_queue:
+        edit_message_text(1, 10, 'a')
+        edit_message_text(1, 11, 'b')
+    assert outbound_queue.flush() is None
+    assert sent == [10, 11]
+
+
+def test_edit_without_message_is_dropped(monkeypatch):
+    sent = []
+    monkeypatch.setattr(telegram, 'request', lambda endpoint, data, deadline: sent.append(data))
+    with OutboundQueue(deadline()) as outbound_queue:
+        assert edit_message_text(1, 0, 'Something went wrong.') == Outcome.BAD_REQUEST
+    assert outbound_queue.edits == {}
+    assert edit_message_text(1, 0, 'Something went wrong.') == Outcome.BAD_REQUEST
+    assert sent == []
@@ -0,0 +1,227 @@
+import json
+import time
+
+import pytest
+
+import app
+import dedup
+import outbox
+import sweeper
+from dedup import MemoryLedger
+from jio import JIO_DELIVERY, JIO_GST, JIO_SPLIT, JIO_TYPE, Jio
+from outbox import DeferredMessages, DynamoDBOutbox, OutboxEntry, SqliteOutbox, defer_message, defer_with, delivered, drain
+
+
+def command(update_id, text='/vieworder'):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': -100, 'type': 'supergroup', 'title': 'Supper'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'A'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        }
+    }
+
+
+def deadline():
+    return time.monotonic() + 2
+
+
+class Throttled(Exception):
+    # as raised by the dynamodb client
+    response = {'Error': {'Code': 'ProvisionedThroughputExceededException'}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    ledger = MemoryLedger()
+    monkeypatch.setattr(dedup, '_LEDGER', ledger)
+    return ledger
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    updates = []
+    monkeypatch.setattr(app, 'parse_update', updates.append)
+    return updates
+
+
+@pytest.fixture
+def sqlite_outbox(monkeypatch, tmp_path):
+    sqlite_outbox = SqliteOutbox(str(tmp_path / 'outbox.sqlite3'))
+    monkeypatch.setattr(outbox, '_OUTBOX', sqlite_outbox)
+    return sqlite_outbox
+
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def any_outbox(request, dynamodb, monkeypatch, tmp_path):
+    any_outbox = DynamoDBOutbox() if request.param == 'dynamodb' else SqliteOutbox(str(tmp_path / 'outbox.sqlite3'))
+    monkeypatch.setattr(outbox, '_OUTBOX', any_outbox)
+    return any_outbox
+
+
+def open_jio(chat_id):
+    Jio.create(chat_id, 1, JIO_TYPE[0], 15, JIO_SPLIT[0], JIO_GST[0], JIO_DELIVERY)
+    Jio.exists(chat_id).add_item(1, 'A', 'Teh Ping', 150)
+
+
+def test_redelivered_update_is_skipped(ledger, handled):
+    app.process_update(command(1), deadline())
+    app.process_update(command(1), deadline())
+    app.process_update(command(2), deadline())
+    assert [update['update_id'] for update in handled] == [1, 2]
+
+
+def test_ignored_update_is_not_claimed(ledger, handled):
+    update = command(1)
+    del update['message']['entities']
+    app.process_update(update, deadline())
+    assert not handled
+    assert 1 not in ledger.expires
+
+
+def test_failed_update_is_processed_again(ledger, monkeypatch):
+    def fail(update):
+        raise Throttled()
+    monkeypatch.setattr(app, 'parse_update', fail)
+    with pytest.raises(Throttled):
+        app.process_update(command(1), deadline())
+    handled = []
+    monkeypatch.setattr(app, 'parse_update', handled.append)
+    app.process_update(command(1), deadline())
+    assert len(handled) == 1
+
+
+def test_update_failing_for_good_is_not_processed_again(ledger, monkeypatch):
+    calls = []
+
+    def fail(update):
+        calls.append(update)
+        raise KeyError('BOT_OWNER')
+    monkeypatch.setattr(app, 'parse_update', fail)
+    assert app.lambda_handler({'body': json.dumps(command(1))}, None)['statusCode'] == 200
+    assert app.lambda_handler({'body': json.dumps(command(1))}, None)['statusCode'] == 200
+    assert len(calls) == 1
+
+
+def test_transient():
+    from botocore.exceptions import EndpointConnectionError
+    from stub_dynamodb import TransactionCanceledException
+    assert app.transient(Throttled())
+    assert app.transient(EndpointConnectionError(endpoint_url='https://dynamodb'))
+    assert app.transient(TransactionCanceledException([{'Code': 'None'}, {'Code': 'TransactionConflict'}]))
+    assert not app.transient(TransactionCanceledException([{'Code': 'ConditionalCheckFailed'}]))
+    assert not app.transient(KeyError('BOT_OWNER'))
+
+
+def test_bot_added_without_owner(ledger, sqlite_outbox, monkeypatch):
+    monkeypatch.setenv('BOT_ID', '42')
+    monkeypatch.delenv('BOT_OWNER', raising=False)
+    update = command(1)
+    del update['message']['entities'], update['message']['text']
+    update['message']['new_chat_members'] = [{'id': 42, 'is_bot': True, 'first_name': 'Supper Bot'}]
+    assert app.lambda_handler({'body': json.dumps(update)}, None)['statusCode'] == 200
+    assert sqlite_outbox.pending(10) == []
+    monkeypatch.setenv('BOT_OWNER', '7')
+    update['update_id'] = 2
+    app.lambda_handler({'body': json.dumps(update)}, None)
+    assert [entry['messages'] for entry in sqlite_outbox.pending(10)] == [[(7, 'Added to chat: Supper')]]
+
+
+def test_update_is_processed_again_after_its_lease(ledger, handled):
+    # an invocation that claimed the update and timed out
+    assert ledger.claim(1, 0.05)
+    app.process_update(command(1), deadline())
+    assert not handled
+    time.sleep(0.1)
+    app.process_update(command(1), deadline())
+    assert len(handled) == 1
+    # completed updates are kept for a day, not just for the lease
+    time.sleep(0.1)
+    app.process_update(command(1), time.monotonic())
+    assert len(handled) == 1
+
+
+def test_lambda_handler_answers_failed_updates_with_an_error(ledger, monkeypatch):
+    def fail(update):
+        raise Throttled()
+    monkeypatch.setattr(app, 'parse_update', fail)
+    response = app.lambda_handler({'body': json.dumps(command(1))}, None)
+    assert response['statusCode'] == 500
+
+
+def test_deferred_messages_are_recorded_once(sqlite_outbox):
+    for _ in range(2):
+        # the same update recorded by two deliveries
+        with DeferredMessages(7) as deferred_messages:
+            defer_message(-100, 'summary')
+            defer_message(1, 'you owe')
+        deferred_messages.record()
+    assert [entry['messages'] for entry in sqlite_outbox.pending(10)] == [[(-100, 'summary'), (1, 'you owe')]]
+
+
+def test_drain_keeps_messages_to_retry(sqlite_outbox, monkeypatch):
+    sqlite_outbox.record([OutboxEntry(id=1, messages=[(1, 'a'), (2, 'b'), (3, 'c')]),
+                          OutboxEntry(id=2, messages=[(1, 'd')])])
+    status_codes = {1: 200, 2: 429, 3: 403}
+
+    class Dispatcher:
+        def send_messages(self, messages):
+            return [{'chat_id': chat_id, 'ok': status_codes[chat_id] == 200, 'status_code': status_codes[chat_id],
+                     'attempts': 1} for chat_id, _ in messages]
+    monkeypatch.setattr(outbox, 'get_dispatcher', Dispatcher)
+    # the blocked user is not retried, the rate limited message is
+    assert drain() == 3
+    assert sqlite_outbox.pending(10) == [OutboxEntry(id=1, messages=[(2, 'b')])]
+
+
+def test_messages_are_recorded_with_the_close(any_outbox):
+    open_jio(-100)
+    jio = Jio.exists(-100)
+    with DeferredMessages(7) as deferred_messages:
+        assert defer_with([(-100, 'summary')], lambda writes: jio.close(None, writes))
+        deferred_messages.record()
+    assert [entry['messages'] for entry in any_outbox.pending(10)] == [[(-100, 'summary')]]
+    assert Jio.exists(-100) is None
+
+
+def test_messages_are_not_recorded_without_the_close(any_outbox, dynamodb):
+    open_jio(-100)
+    jio = Jio.exists(-100)
+    # replaced by another jio in between
+    dynamodb.items[(-100, 0)]['opened'] += 1
+    with DeferredMessages(7) as deferred_messages:
+        assert not defer_with([(-100, 'summary')], lambda writes: jio.close(None, writes))
+        deferred_messages.record()
+    assert any_outbox.pending(10) == []
+
+
+def test_sweep_records_the_jios_it_closed(any_outbox, monkeypatch):
+    for chat_id in (-1, -2, -3):
+        open_jio(chat_id)
+    close = Jio.close
+
+    def fail(jio, *args):
+        if jio.chat_id == -2:
+            raise RuntimeError('throttled')
+        return close(jio, *args)
+    monkeypatch.setattr(Jio, 'close', fail)
+    # the jio that failed to close does not stop the others
+    assert sweeper.sweep(int(time.time()) + 20 * 60) == 2
+    entries = any_outbox.pending(10)
+    assert sorted(entry['messages'][0][0] for entry in entries) == [-3, -1]
+    assert all(entry['messages'][0][1].startswith('Closing time of 15 mins reached.') for entry in entries)
+    assert all(entry['messages'][1][0] == 1 for entry in entries)
+    assert len({entry['id'] for entry in entries}) == 2
+    assert Jio.exists(-2)
+
+
+def test_delivered():
+    assert delivered({'chat_id': 1, 'ok': True, 'status_code': 200, 'attempts': 1})
+    assert delivered({'chat_id': 1, 'ok': False, 'status_code': 403, 'attempts': 1})
+    assert not delivered({'chat_id': 1, 'ok': False, 'status_code': 429, 'attempts': 3})
+    assert not delivered({'chat_id': 1, 'ok': False, 'status_code': 502, 'attempts': 3})
+    assert not delivered({'chat_id': 1, 'ok': False, 'status_code': 0, 'attempts': 0})